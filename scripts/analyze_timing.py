@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import sys
+
+from argparse import ArgumentParser
+from bisect import bisect_right
+
+from batch_billing import BACKENDS, DEFAULT_BACKEND
+from billing import CACHED, SUBWORKFLOW, SUBWORKFLOW_KEY, TASK, call_key, from_iso
+from costs_json_to_csv import write_csv
+
+
+# Which phase of a call each of its executionEvents is, by description
+# prefix. Cromwell's own events are the queue before a job runs; the
+# backend's events break down the time spent in RunningJob.
+QUEUE_EVENTS = ("Pending", "RequestingExecutionToken", "WaitingForValueStore",
+                "PreparingJob", "CheckingCallCache", "CheckingJobStore")
+LOCALIZATION_EVENTS = ("Localization", "Pulling", "ContainerSetup")
+RUN_EVENTS = ("UserAction",)
+DELOCALIZATION_EVENTS = ("Delocalization",)
+RUNNING_EVENT = "RunningJob"
+
+# Call fields the dependency graph needs, besides those the metadata cache keeps for costing
+DEPENDENCY_CALL_KEYS = {"inputs", "outputs"}
+
+PHASES = ["queue", "localization", "run", "delocalization", "runningJobWait"]
+CALL_FIELDS = ["call", "kind", "startTime", "endTime", "durationSeconds", *PHASES]
+
+
+class Call:
+    """
+    One task run, or cache hit, placed on the root workflow's timeline.
+
+    Attempts of the same call share a key, its fully qualified name and shard.
+    """
+    def __init__(self, name, key, kind, call):
+        self.name = name
+        self.key = key
+        self.kind = kind
+        self.call = call
+        self.start = from_iso(call["start"])
+        self.end = from_iso(call["end"])
+
+    @property
+    def seconds(self):
+        return (self.end - self.start).total_seconds()
+
+    def phases(self):
+        """
+        Seconds of each of PHASES in the call, from its executionEvents.
+
+        runningJobWait is the part of RunningJob not spent localizing,
+        running, or delocalizing, e.g. waiting for a VM.
+        """
+        seconds = dict.fromkeys(PHASES, 0.0)
+        running = 0.0
+        for event in self.call.get("executionEvents", []):
+            if "startTime" not in event or "endTime" not in event:
+                continue
+            description = event["description"]
+            duration = (from_iso(event["endTime"]) - from_iso(event["startTime"])).total_seconds()
+            if description == RUNNING_EVENT:
+                running += duration
+            elif description.startswith(QUEUE_EVENTS):
+                seconds["queue"] += duration
+            elif description.startswith(LOCALIZATION_EVENTS):
+                seconds["localization"] += duration
+            elif description.startswith(RUN_EVENTS):
+                seconds["run"] += duration
+            elif description.startswith(DELOCALIZATION_EVENTS):
+                seconds["delocalization"] += duration
+        busy = seconds["localization"] + seconds["run"] + seconds["delocalization"]
+        seconds["runningJobWait"] = max(0.0, running - busy)
+        return seconds
+
+
+def file_values(value):
+    """Every string within a call's inputs or outputs value, however nested."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, list):
+        for item in value:
+            yield from file_values(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from file_values(item)
+
+
+def timeline_calls(billing, location, workflow_id, path=""):
+    """Every task and cache hit in a workflow and its subworkflows, as Calls."""
+    metadata = billing.metadata_cache.get(location, workflow_id)
+    calls = []
+    for call_name, attempts in metadata.get("calls", {}).items():
+        for call in attempts:
+            name = f"{path}/{call_key(call_name, call)}" if path else call_key(call_name, call)
+            kind = billing.backend.call_kind(call)
+            if kind in (TASK, CACHED) and "start" in call and "end" in call:
+                key = (f"{path}/{call_name}", call["shardIndex"])
+                calls.append(Call(name, key, kind, call))
+            elif kind == SUBWORKFLOW:
+                calls += timeline_calls(billing, location, call[SUBWORKFLOW_KEY], name)
+    return calls
+
+
+def dependencies(calls):
+    """
+    {call: [(call, how)]} of what each call waited on.
+
+    A call depends on the calls that produced files among its inputs
+    ("data"), and a retry on its previous attempt ("retry").
+    """
+    producers = {}
+    for call in calls:
+        for value in file_values(call.call.get("outputs", {})):
+            producers.setdefault(value, call)
+    attempts = {(call.key, call.call.get("attempt", 1)): call for call in calls}
+    depends = {}
+    for call in calls:
+        found = {producers[value]: "data" for value in file_values(call.call.get("inputs", {}))
+                 if value in producers and producers[value] is not call}
+        previous = attempts.get((call.key, call.call.get("attempt", 1) - 1))
+        if previous is not None:
+            found[previous] = "retry"
+        depends[call] = list(found.items())
+    return depends
+
+
+def critical_path(calls):
+    """
+    The chain of calls, ending with the last to finish, that determined
+    when the workflow finished.
+
+    From the last call back, each step is to whichever dependency of the
+    call finished last. A call without known dependencies is taken to
+    have waited on the last call to finish before it started.
+    Returns [(call, how it depended on the one before)] in order of time.
+    """
+    if not calls:
+        return []
+    depends = dependencies(calls)
+    by_end = sorted(calls, key=lambda call: call.end)
+    ends = [call.end for call in by_end]
+    path = []
+    call = by_end[-1]
+    seen = set()
+    while call is not None and call not in seen:
+        seen.add(call)
+        candidates = [(dependency, how) for dependency, how in depends[call] if dependency.end <= call.end]
+        if candidates:
+            previous, how = max(candidates, key=lambda candidate: candidate[0].end)
+        else:
+            i = bisect_right(ends, call.start)
+            previous, how = (by_end[i - 1], "timeline") if i else (None, None)
+        path.append((call, how))
+        call = previous
+    path.reverse()
+    return path
+
+
+def analyze(billing, location, workflow_id):
+    """
+    Critical path and time per phase, overall and per call, of a workflow.
+
+    Data dependencies are only found if billing's metadata cache keeps
+    DEPENDENCY_CALL_KEYS, as it does when run from the command line.
+    """
+    metadata = billing.metadata_cache.get(location, workflow_id)
+    calls = timeline_calls(billing, location, workflow_id)
+    rows = []
+    totals = dict.fromkeys(PHASES, 0.0)
+    for call in calls:
+        phases = call.phases()
+        for phase in PHASES:
+            totals[phase] += phases[phase]
+        rows.append({"call": call.name, "kind": call.kind,
+                     "startTime": call.call["start"], "endTime": call.call["end"],
+                     "durationSeconds": call.seconds, **phases})
+    rows.sort(key=lambda row: row["runningJobWait"], reverse=True)
+
+    path = critical_path(calls)
+    steps = []
+    previous = None
+    for call, how in path:
+        wait = (call.start - previous.end).total_seconds() if previous else 0.0
+        steps.append({"call": call.name, "startTime": call.call["start"], "endTime": call.call["end"],
+                      "durationSeconds": call.seconds, "waitSeconds": max(0.0, wait), "dependency": how})
+        previous = call
+    duration = from_iso(metadata["end"]) - from_iso(metadata["start"])
+    return {
+        "workflowId": workflow_id,
+        "startTime": metadata["start"],
+        "endTime": metadata["end"],
+        "wallClockSeconds": duration.total_seconds(),
+        "criticalPath": {
+            "seconds": sum(step["durationSeconds"] for step in steps),
+            "waitSeconds": sum(step["waitSeconds"] for step in steps),
+            "calls": steps
+        },
+        "phaseSeconds": totals,
+        "calls": rows
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Report the critical path of a workflow, and where its calls spent their time, from local metadata files.")
+    parser.add_argument("workflow_id")
+    parser.add_argument("metadata_dir", help="directory of <workflow_id>.json metadata files, local or gs://")
+    parser.add_argument("--backend", choices=BACKENDS.keys(), default=DEFAULT_BACKEND,
+                        help=f"Cromwell backend the metadata came from. Default {DEFAULT_BACKEND}")
+    parser.add_argument("--csv", action="store_true", default=False,
+                        help="write the per-call breakdown as CSV instead of the JSON report")
+    args = parser.parse_args()
+
+    log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=log_level,
+        format='[%(levelname)s] %(message)s'
+    )
+
+    billing = BACKENDS[args.backend]
+    billing.metadata_cache.call_keys |= DEPENDENCY_CALL_KEYS
+    report = analyze(billing, args.metadata_dir.rstrip('/'), args.workflow_id)
+    if args.csv:
+        write_csv(sys.stdout, report["calls"], fieldnames=CALL_FIELDS)
+    else:
+        print(json.dumps(report, indent=4))
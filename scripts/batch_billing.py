@@ -0,0 +1,189 @@
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+import billing
+import estimate_billing
+import gb_estimate_billing
+import metadata_index
+from costs_json_to_csv import TASK_FIELDS, iter_task_costs, task_fields, write_csv, write_parquet
+
+
+# How each backend's workflows are costed, see billing.Billing
+BACKENDS = {
+    "papi": estimate_billing.BILLING,
+    "batch": gb_estimate_billing.BILLING,
+}
+DEFAULT_BACKEND = "papi"
+DEFAULT_WORKERS = 4
+
+SUBWORKFLOW_ID_PATTERN = re.compile(rb'"subWorkflowId"\s*:\s*"([^"]+)"')
+
+
+def scan_workflow(path):
+    """
+    (whether the metadata file at path is for a root workflow, IDs of
+    the subworkflows it references), without parsing it.
+    """
+    if os.path.getsize(path) == 0:
+        return False, set()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+        is_root = contents.find(b'"parentWorkflowId"') == -1
+        referenced = {match.group(1).decode() for match in SUBWORKFLOW_ID_PATTERN.finditer(contents)}
+    return is_root, referenced
+
+
+def root_workflow_ids(metadata_dir):
+    """
+    IDs of every root workflow with metadata in local directory or index metadata_dir.
+
+    Workflows without a parent that another workflow in metadata_dir
+    runs as a subworkflow are left out, and logged, so they aren't
+    costed twice. Runs other runs' calls were cache hits on are still
+    roots, since their own tasks cost money too.
+    """
+    if metadata_index.is_index(metadata_dir):
+        return metadata_index.root_workflow_ids(metadata_dir)
+    roots = set()
+    subworkflows = set()
+    for path in Path(metadata_dir).glob("*.json"):
+        is_root, references = scan_workflow(path)
+        if is_root:
+            roots.add(path.stem)
+        subworkflows |= references
+    return metadata_index.without_subworkflows(roots, subworkflows)
+
+
+def cost_workflows(location, workflow_ids, backend=DEFAULT_BACKEND, workers=DEFAULT_WORKERS, jobs=1,
+                   vectorized=False, store=None):
+    """
+    Cost many workflows, sharing one metadata cache between them.
+
+    Workflows are costed on a pool of `workers` threads, which overlaps
+    reading their metadata; costing itself is CPU bound, so runs one
+    at a time. With `jobs` above 1, every workflow's metadata is first
+    loaded and parsed on that many processes, see metadata_cache.prefetch. With vectorized, each
+    workflow's tasks are costed as one batch of arrays. With a
+    billing.CostStore, costs it holds for unchanged workflows are reused
+    and the rest are saved to it. Yields (workflow_id, cost) as each
+    workflow finishes, with cost None if it couldn't be costed. At most
+    twice `workers` workflows are submitted at once, and each is let go
+    once yielded, so memory doesn't grow with the number of workflows.
+    """
+    costing = BACKENDS[backend]
+    cost_workflow = costing.cost_workflow_vectorized if vectorized else costing.cost_workflow
+    if store:
+        cost_workflow = partial(costing.cost_and_save, store, vectorized=vectorized)
+        stale = []
+        for workflow_id in workflow_ids:
+            cost = costing.saved_cost(store, location, workflow_id)
+            if cost is None:
+                stale.append(workflow_id)
+            else:
+                yield workflow_id, cost
+        workflow_ids = stale
+    if jobs > 1 and workflow_ids:
+        costing.prefetch(location, workflow_ids, jobs)
+    workflow_ids = iter(workflow_ids)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(cost_workflow, location, workflow_id): workflow_id
+                   for workflow_id in islice(workflow_ids, 2 * workers)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                workflow_id = pending.pop(future)
+                for next_id in islice(workflow_ids, 1):
+                    pending[pool.submit(cost_workflow, location, next_id)] = next_id
+                try:
+                    cost = future.result()
+                except Exception as e:
+                    logging.error(f"Could not cost workflow {workflow_id}: {e!r}")
+                    cost = None
+                yield workflow_id, cost
+
+
+def iter_rows(costs):
+    """Task rows of each (workflow_id, cost) in costs, prefixed with the root workflow's ID."""
+    for workflow_id, cost in costs:
+        if cost is None:
+            continue
+        for row in iter_task_costs(cost):
+            yield {"workflowId": workflow_id, **row}
+
+
+def write_parquet_dataset(root, costs):
+    """
+    Write the task rows of each (workflow_id, cost) in costs into a
+    Parquet dataset at root, one workflow at a time, see
+    costs_json_to_csv.write_parquet.
+    """
+    for workflow_id, cost in costs:
+        if cost is not None:
+            write_parquet(root, workflow_id, iter_task_costs(cost))
+
+
+def write_rows(fp, costs, output_format="csv", fieldnames=TASK_FIELDS):
+    """
+    Stream the task rows of each (workflow_id, cost) in costs to fp, as CSV or JSONL.
+
+    Rows are written as each workflow's cost arrives, so memory use
+    doesn't grow with the number of workflows. CSV columns are
+    workflowId then fieldnames, by default costs_json_to_csv.TASK_FIELDS
+    without any backend's details.
+    """
+    if output_format == "jsonl":
+        for row in iter_rows(costs):
+            fp.write(json.dumps(row) + "\n")
+    else:
+        write_csv(fp, iter_rows(costs), fieldnames=["workflowId", *fieldnames])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Estimate billing for many workflows at once, writing one aggregated table of task costs.")
+    parser.add_argument("metadata_dir",
+                        help="directory of <workflow_id>.json metadata files, local or gs://, or a metadata index")
+    parser.add_argument("workflow_ids", nargs="*",
+                        help="root workflows to cost. Defaults to every root workflow in a local metadata_dir.")
+    parser.add_argument("--workflow-ids-file",
+                        help="file of root workflow IDs to cost, one per line")
+    parser.add_argument("--backend", choices=BACKENDS.keys(), default=DEFAULT_BACKEND,
+                        help=f"papi for estimate_billing.py costing, batch for gb_estimate_billing.py. Default {DEFAULT_BACKEND}")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"threads reading workflows' metadata concurrently. This only overlaps reads, "
+                        f"use --jobs to parse on several processes. Default {DEFAULT_WORKERS}")
+    billing.add_arguments(parser)
+    args = parser.parse_args()
+    billing.configure(BACKENDS[args.backend], args)
+
+    location = args.metadata_dir.rstrip('/')
+    workflow_ids = list(args.workflow_ids)
+    if args.workflow_ids_file:
+        workflow_ids += [line.strip() for line in Path(args.workflow_ids_file).read_text().splitlines()
+                         if line.strip()]
+    if not workflow_ids:
+        if location.startswith("gs://"):
+            parser.error("workflow IDs must be given for a gs:// metadata_dir")
+        workflow_ids = root_workflow_ids(location)
+    logging.info(f"Costing {len(workflow_ids)} workflows")
+
+    store = billing.CostStore(args.incremental) if args.incremental else None
+    costs = cost_workflows(location, workflow_ids, backend=args.backend,
+                           workers=args.workers, jobs=args.jobs, vectorized=args.vectorized, store=store)
+    if args.parquet:
+        write_parquet_dataset(args.parquet, costs)
+    else:
+        write_rows(sys.stdout, costs, args.format,
+                   task_fields(BACKENDS[args.backend].backend.task_detail_fields()))
+    BACKENDS[args.backend].metadata_cache.log_stats()
+    if store:
+        store.log_stats()
@@ -0,0 +1,104 @@
+"""
+Compare peak memory and wall time of loading workflow metadata in full
+with json.load against metadata_stream.load_costing_fields.
+
+    python3 benchmarks/metadata_loading.py --calls 20000
+
+Generates a synthetic metadata file shaped like Cromwell's, with bulky
+inputs, outputs, and command lines on every call, then loads it in a
+fresh subprocess per mode so each mode's peak RSS is measured alone.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def synthetic_metadata(calls, shards):
+    def event(description, start, end):
+        return {"description": description,
+                "startTime": f"2024-01-01T{start:02d}:00:00.000Z",
+                "endTime": f"2024-01-01T{end:02d}:00:00.000Z"}
+
+    def call(i, shard):
+        return {
+            "executionStatus": "Done", "backendStatus": "Success",
+            "shardIndex": shard, "attempt": 1, "preemptible": True,
+            "start": "2024-01-01T00:00:00.000Z", "end": "2024-01-01T03:00:00.000Z",
+            "executionEvents": [event("RunningJob", 0, 3), event("UpdatingJobStore", 3, 3)],
+            "runtimeAttributes": {"cpu": "4", "memory": "16 GB", "disks": "local-disk 100 SSD"},
+            "jes": {"machineType": "custom-4-16384", "zone": "us-central1-c"},
+            "commandLine": "set -euo pipefail\n" + "run_tool --flag value " * 200,
+            "inputs": {f"input_{k}": f"gs://bucket/inputs/{i}/{shard}/file_{k}.bam" for k in range(40)},
+            "outputs": {f"output_{k}": f"gs://bucket/outputs/{i}/{shard}/file_{k}.vcf" for k in range(20)},
+        }
+
+    return {"id": "benchmark", "status": "Succeeded",
+            "start": "2024-01-01T00:00:00.000Z", "end": "2024-01-01T03:00:00.000Z",
+            "submittedFiles": {"workflow": "x" * 2**20},
+            "calls": {f"wf.task_{i}": [call(i, shard) for shard in range(shards)]
+                      for i in range(calls // shards)}}
+
+
+def load(mode, path):
+    if mode == "json":
+        with open(path, 'rb') as f:
+            return json.load(f)
+    elif mode == "stream":
+        import metadata_stream
+        with open(path, 'rb') as f:
+            return metadata_stream.load_costing_fields(f)
+
+
+def child(mode, path):
+    start = time.perf_counter()
+    if mode != "baseline":
+        load(mode, path)
+    seconds = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on macOS, KiB elsewhere
+        maxrss //= 1024
+    print(json.dumps({"seconds": seconds, "maxrss_mib": maxrss / 1024}))
+
+
+def run(mode, path):
+    output = subprocess.check_output([sys.executable, __file__, "--child", mode, path])
+    return json.loads(output)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark full vs streaming metadata loading.")
+    parser.add_argument("--calls", type=int, default=20000, help="number of calls in the generated metadata")
+    parser.add_argument("--shards", type=int, default=10, help="shards per call name")
+    parser.add_argument("--metadata", help="benchmark an existing metadata file instead of generating one")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help="internal: load once and report")
+    parser.add_argument("--generate", metavar="PATH", help="internal: write synthetic metadata to PATH")
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        sys.exit(0)
+    if args.generate:
+        with open(args.generate, 'w') as f:
+            json.dump(synthetic_metadata(args.calls, args.shards), f)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.metadata
+        if not path:
+            path = f"{tmpdir}/metadata.json"
+            # generated in a subprocess, since peak RSS carries over to children on some platforms
+            subprocess.check_call([sys.executable, __file__, "--generate", path,
+                                   "--calls", str(args.calls), "--shards", str(args.shards)])
+        print(f"metadata file: {os.path.getsize(path) / 2**20:.1f} MiB")
+        print(f"{'mode':<10}{'seconds':>10}{'peak RSS MiB':>15}")
+        for mode in ["baseline", "json", "stream"]:
+            result = run(mode, path)
+            print(f"{mode:<10}{result['seconds']:>10.2f}{result['maxrss_mib']:>15.1f}")
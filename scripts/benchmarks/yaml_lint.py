@@ -0,0 +1,145 @@
+"""
+Compare wall time of validate_immuno_yaml's single-pass lint engine
+against the line-rescanning checks it replaced, and check both report
+the same thing.
+
+    python3 benchmarks/yaml_lint.py --keys 20000
+
+Generates a synthetic immuno YAML with many keys, list items, and
+commented-out lines. --empty-keys adds a run of nested active keys with
+no values, the worst case for the old empty-key check.
+"""
+import os
+import random
+import re
+import sys
+import time
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import validate_immuno_yaml  # noqa: E402
+
+
+# The checks as they were before the lint engine, for comparison
+
+def legacy_commenting_issues(yaml_text):
+    issues = []
+    lines = yaml_text.splitlines()
+    for i, line in enumerate(lines):
+        if re.match(r"#\s*immuno\.problematic_amino_acids\s*:", line):
+            j = i + 1
+            while j < len(lines) and not re.match(r"^\s*immuno\.", lines[j]):
+                if re.match(r"^\s*-\s+\S", lines[j]):
+                    issues.append(f"Improperly commented list item after commented key on line {i+1}: '{lines[j].strip()}'")
+                    break
+                j += 1
+    return issues
+
+
+def legacy_empty_active_keys(yaml_text):
+    issues = []
+    lines = yaml_text.splitlines()
+    for i, line in enumerate(lines):
+        if re.match(r"^\s*immuno\.\w+:\s*$", line):
+            key_line = line.strip()
+            key_indent = len(line) - len(line.lstrip())
+            has_active_item = False
+            j = i + 1
+            while j < len(lines):
+                next_line = lines[j]
+                next_indent = len(next_line) - len(next_line.lstrip())
+                if next_indent <= key_indent and re.match(r"^\s*\w", next_line):
+                    break
+                if re.match(r"^\s*-\s+\S", next_line):
+                    has_active_item = True
+                    break
+                j += 1
+            if not has_active_item:
+                issues.append(f"Key '{key_line}' appears active but has only commented-out list items (or none).")
+    return issues
+
+
+def legacy_commented_blocks(yaml_text):
+    results = []
+    lines = yaml_text.splitlines()
+    for check_name, check_info in validate_immuno_yaml.COMMENTED_BLOCKS.items():
+        found = False
+        for idx, line in enumerate(lines):
+            if check_info['keyword'] in line:
+                found = True
+                if line.strip().startswith('#'):
+                    results.append(check_info['no_text_message'])
+                else:
+                    results.append(check_info['has_text_message'])
+                    j = idx + 1
+                    while j < len(lines):
+                        next_line = lines[j].strip()
+                        if next_line.startswith('#') or next_line.startswith('immuno.'):
+                            break
+                        if next_line:
+                            results.append(f"  {next_line}")
+                        j += 1
+                break
+        if not found:
+            results.append(f"{check_name} not found in YAML")
+    return results
+
+
+def legacy_lint(yaml_text):
+    return [legacy_commenting_issues(yaml_text), legacy_empty_active_keys(yaml_text),
+            legacy_commented_blocks(yaml_text)]
+
+
+def synthetic_yaml(keys, empty_keys, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(keys):
+        choice = rng.random()
+        if choice < 0.05:
+            lines.append("# immuno.problematic_amino_acids:")
+        elif choice < 0.06:
+            lines.append(rng.choice(["immuno.clinical_mhc_classI_alleles:",
+                                     "# immuno.clinical_mhc_classII_alleles:"]))
+        elif choice < 0.3:
+            lines.append(f"immuno.key_{i}:")
+        else:
+            lines.append(f"immuno.key_{i}: value_{i}")
+        for _ in range(rng.randrange(4)):
+            indent = " " * rng.choice([0, 2, 4])
+            lines.append(rng.choice([f"{indent}- item_{i}", f"{indent}#  - item_{i}", "",
+                                     f"{indent}nested_{i}:", f"{indent}# comment"]))
+    for i in range(empty_keys):
+        lines.append(" " * i + f"immuno.empty_{i}:")
+    return "\n".join(lines) + "\n"
+
+
+def timed(fn, yaml_text):
+    start = time.perf_counter()
+    result = fn(yaml_text)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the single-pass YAML lint engine against the checks it replaced.")
+    parser.add_argument("--keys", type=int, default=20000, help="immuno keys in the generated YAML")
+    parser.add_argument("--empty-keys", type=int, default=2000,
+                        help="nested empty active keys appended to the generated YAML")
+    parser.add_argument("--yaml", help="benchmark an existing YAML file instead of generating one")
+    args = parser.parse_args()
+
+    if args.yaml:
+        with open(args.yaml) as f:
+            yaml_text = f.read()
+    else:
+        yaml_text = synthetic_yaml(args.keys, args.empty_keys)
+    print(f"YAML: {len(yaml_text.splitlines())} lines")
+    print(f"{'mode':<10}{'seconds':>10}")
+    legacy_seconds, legacy = timed(legacy_lint, yaml_text)
+    print(f"{'legacy':<10}{legacy_seconds:>10.3f}")
+    engine_seconds, engine = timed(validate_immuno_yaml.lint, yaml_text)
+    print(f"{'engine':<10}{engine_seconds:>10.3f}")
+    if engine != legacy:
+        sys.exit("Results differ between the legacy checks and the lint engine")
+    print("Results match")
@@ -0,0 +1,515 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from datetime import datetime
+from functools import lru_cache, partial
+from pathlib import Path
+
+import metadata_index
+import price_catalog
+from costs_json_to_csv import iter_task_costs, task_fields, write_csv, write_parquet
+from metadata_cache import DEFAULT_CACHE_SIZE, MetadataCache, prefetch
+
+
+# Shared costing of Cromwell workflows from their metadata. What differs
+# between Cromwell backends, e.g. PAPI and GCP Batch, is how their
+# metadata describes a call; each backend's script supplies a Backend
+# subclass saying how to read it, and costs with a Billing around it.
+
+CACHED_KEY = "callCaching"
+SUBWORKFLOW_KEY = "subWorkflowId"
+
+SECONDS_PER_HOUR = 60 * 60
+SECONDS_PER_MONTH = 30 * 24 * SECONDS_PER_HOUR
+
+# What a call in workflow metadata is, as far as costing is concerned
+TASK = "task"
+CACHED = "cached"
+SUBWORKFLOW = "subworkflow"
+
+ZERO_COST = {"totalCost": 0, "diskCost": 0, "cpuCost": 0, "memoryCost": 0}
+
+
+def read_json(filename, parse=json.load):
+    """
+    read+parse a JSON file into memory. Works for local and gs:// files
+
+    parse is given the file opened in binary mode, e.g.
+    metadata_stream.load_costing_fields to only keep what costing needs.
+    """
+    logging.debug(f"Reading JSON {filename}")
+    if filename.startswith("gs://"):
+        tmpdir = os.environ.get("TMPDIR", "/tmp")
+        tmpfile = f"{Path(tmpdir)}/{Path(filename).name}"
+        subprocess.call(['gsutil', '-q', 'cp', '-n', filename, tmpfile])
+        with open(tmpfile, 'rb') as f:
+            return parse(f)
+    else:
+        with open(filename, 'rb') as f:
+            return parse(f)
+
+
+def load_metadata(location, workflow_id, parse=json.load):
+    """
+    Metadata of workflow_id, from <location>/<workflow_id>.json, local
+    or gs://, or from a metadata index if location is one.
+    """
+    if metadata_index.is_index(location):
+        return metadata_index.load_metadata(location, workflow_id)
+    return read_json(f"{location}/{workflow_id}.json", parse=parse)
+
+
+def from_iso(datetime_str):
+    return datetime.fromisoformat(datetime_str.rstrip('Z'))
+
+
+@lru_cache(maxsize=None)
+def parse_disks(disks):
+    """Size in GB and type of a single-disk disks string, e.g. 'local-disk 100 SSD'."""
+    if len(disks.split(" ")) != 3:
+        raise NotImplementedError(f"Not handling multiple disks yet. {disks}")
+
+    total_gb, disk_type = disks.split(" ")[1:]
+    return int(total_gb), disk_type
+
+
+def parse_cache_result(call):
+    # example: "Cache Hit: 7f84432e-c1e2-42d6-b3ba-c48521c2db47:immuno.extractAlleles:-1"
+    # "Cache Hit: (uuid):(callName):(shardIndex)"
+    result = call["callCaching"]["result"]
+    match = re.match(
+        "^Cache Hit: ([-0-9a-f]+):(.+):(-1|[0-9]+)$",
+        result
+    )
+    # These don't do anything to handle the error -- just let the script fail naturally
+    if not match:
+        logging.error(f"No matches to parse a subworkflow ID out of result {result}")
+    if not len(match.groups()) == 3:
+        logging.error(f"Match did not result in three groups as expected: len({match.groups()}) == {len(match.groups())}")
+    cached_call, call_name, shard_index = match.groups()
+
+    return cached_call, call_name, int(shard_index)
+
+
+def call_key(call_name, call):
+    ck = call_name
+    if call["shardIndex"] != -1:
+        ck += "_shard-" + str(call["shardIndex"])
+    if call["attempt"] > 1:
+        ck += "_retry" + str(call["attempt"] - 1)
+    return ck
+
+
+def metadata_fingerprint(location, workflow_id):
+    """
+    Size and mtime of a workflow's metadata file, as "size:mtime", to
+    tell whether it has changed. None for gs:// or missing metadata.
+    """
+    if metadata_index.is_index(location):
+        return metadata_index.fingerprint(location, workflow_id)
+    if location.startswith("gs://"):
+        return None
+    try:
+        stat = os.stat(f"{location}/{workflow_id}.json")
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class CostStore:
+    """
+    Workflow costs saved by earlier runs, one <workflow_id>.json file each in a directory.
+
+    Each cost is saved with the fingerprint of every metadata file read
+    to cost it, the prices used, and the backend, so it can be reused
+    for as long as none of them change.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.reused = 0
+        self.costed = 0
+        self._lock = threading.Lock()
+
+    def load(self, workflow_id):
+        try:
+            with open(self.path / f"{workflow_id}.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, workflow_id, record):
+        path = self.path / f"{workflow_id}.json"
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, path)
+
+    def count(self, reused):
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.costed += 1
+
+    def log_stats(self):
+        logging.info(f"Saved costs: {self.reused} workflows reused, {self.costed} costed")
+
+
+class Backend:
+    """
+    How to read one Cromwell backend's call metadata for costing.
+
+    Subclasses implement call_kind, machine_duration, and
+    machine_shape, and may override the rest. They should hold no
+    state, so that their methods can be sent to other processes.
+    """
+    def call_kind(self, call):
+        """TASK, CACHED, or SUBWORKFLOW for calls to be costed, else None."""
+        raise NotImplementedError
+
+    def machine_duration(self, task):
+        """ISO 8601 timestamps of when the task's machine started and stopped."""
+        raise NotImplementedError
+
+    def machine_shape(self, task):
+        """Machine family, vCPUs, and memory in GB the task ran on."""
+        raise NotImplementedError
+
+    def region(self, task):
+        """Region the task ran in, or None for the price catalog's default."""
+        return None
+
+    def task_details(self, task):
+        """Backend specific fields to include in a task's costs."""
+        return {}
+
+    def task_detail_fields(self):
+        """Names of the fields task_details returns, in order."""
+        return []
+
+    def ran_task(self, call):
+        """
+        Whether the call ran on a machine of its own, even if it then
+        failed. Such calls used resources, though they may not be costed.
+        """
+        return self.call_kind(call) == TASK
+
+    def log_skipped(self, call_name, ck):
+        logging.warning(f"Not costing {ck}, it is not a completed task, cache hit, or subworkflow")
+
+    def referenced_workflows(self, metadata):
+        """
+        IDs of the subworkflows, and of the workflows holding cached
+        calls, needed to cost metadata.
+        """
+        subworkflow_ids, cached_ids = [], []
+        for calls in metadata.get("calls", {}).values():
+            for call in calls:
+                kind = self.call_kind(call)
+                if kind == CACHED:
+                    cached_ids.append(parse_cache_result(call)[0])
+                elif kind == SUBWORKFLOW:
+                    subworkflow_ids.append(call[SUBWORKFLOW_KEY])
+        return subworkflow_ids, cached_ids
+
+
+class Billing:
+    """
+    Costs workflows for a Backend, from metadata read through a shared
+    MetadataCache, at the unit prices of a PriceCatalog.
+    """
+    def __init__(self, backend, prices, loader=load_metadata, cache_size=DEFAULT_CACHE_SIZE):
+        self.backend = backend
+        self.prices = prices
+        self.metadata_cache = MetadataCache(loader, cache_size)
+
+    def resource_cost(self, seconds, family, vcpus, memory_gb, disk_gb, disk_type,
+                      preemptible=False, region=None, when=""):
+        """
+        cpu, memory, and disk cost of a machine of this shape running for seconds.
+
+        Machines are charged for at least a minute, disks by the second,
+        at the prices in effect on the day of timestamp when.
+        """
+        price = self.prices.machine_prices(family, region, preemptible, when)
+        cpu_cost = max(60, seconds) * vcpus * price["cpu"] / SECONDS_PER_HOUR
+        memory_cost = max(60, seconds) * memory_gb * price["memory"] / SECONDS_PER_HOUR
+        disk_cost = seconds * disk_gb * self.prices.price(disk_type, region=region, when=when) / SECONDS_PER_MONTH
+        return cpu_cost, memory_cost, disk_cost
+
+    def cost_task(self, task):
+        """
+        Calculate the total cost to run this task.
+
+        Returns that total and the values used to calculate it.
+        """
+        start_time, end_time = self.backend.machine_duration(task)
+
+        duration = from_iso(end_time) - from_iso(start_time)
+        total_seconds = duration.total_seconds()
+
+        family, vcpus, memory_gb = self.backend.machine_shape(task)
+        preemptible = task["preemptible"]
+        disks_used = task["runtimeAttributes"]["disks"]
+        total_gb, disk_type = parse_disks(disks_used)
+
+        cpu_cost, memory_cost, disk_cost = self.resource_cost(
+            total_seconds, family, vcpus, memory_gb, total_gb, disk_type,
+            preemptible=preemptible, region=self.backend.region(task), when=task["start"])
+        total_cost = cpu_cost + memory_cost + disk_cost
+
+        return {
+            "durationSeconds": total_seconds,
+            "duration": str(duration),
+            "startTime": task["start"],
+            "endTime": task["end"],
+            "machineStartTime": start_time,
+            "machineEndTime": end_time,
+            **self.backend.task_details(task),
+            "memoryCost": memory_cost,
+            "cpuCost": cpu_cost,
+            "diskCost": disk_cost,
+            "disks": disks_used,
+            "totalCost": total_cost,
+            "attempt": task["attempt"],
+            "preemptible": preemptible,
+            "backendStatus": task["backendStatus"]
+        }
+
+    def cost_tasks(self, tasks):
+        """
+        cost_task for many tasks at once, with identical results.
+
+        Each task's machine shape, disks, and times are pulled out once,
+        then costs for the whole batch are computed as arrays. Requires numpy.
+        """
+        import cost_engine
+        machine_times = [self.backend.machine_duration(task) for task in tasks]
+        shapes = [self.backend.machine_shape(task) for task in tasks]
+        regions = [self.backend.region(task) for task in tasks]
+        disks = [parse_disks(task["runtimeAttributes"]["disks"]) for task in tasks]
+        prices = [self.prices.machine_prices(family, region, task["preemptible"], task["start"])
+                  for task, (family, _, _), region in zip(tasks, shapes, regions)]
+        costs = cost_engine.cost_tasks(
+            starts=[start for start, _ in machine_times],
+            ends=[end for _, end in machine_times],
+            vcpus=[vcpus for _, vcpus, _ in shapes],
+            memory_gb=[memory_gb for _, _, memory_gb in shapes],
+            disk_gb=[total_gb for total_gb, _ in disks],
+            cpu_price=[price["cpu"] for price in prices],
+            memory_price=[price["memory"] for price in prices],
+            disk_price=[self.prices.price(disk_type, region=region, when=task["start"])
+                        for task, (_, disk_type), region in zip(tasks, disks, regions)])
+        return [{
+            "durationSeconds": seconds,
+            "duration": str(duration),
+            "startTime": task["start"],
+            "endTime": task["end"],
+            "machineStartTime": start_time,
+            "machineEndTime": end_time,
+            **self.backend.task_details(task),
+            "memoryCost": memory_cost,
+            "cpuCost": cpu_cost,
+            "diskCost": disk_cost,
+            "disks": task["runtimeAttributes"]["disks"],
+            "totalCost": total_cost,
+            "attempt": task["attempt"],
+            "preemptible": task["preemptible"],
+            "backendStatus": task["backendStatus"]
+        } for task, (start_time, end_time), seconds, duration, cpu_cost, memory_cost, disk_cost, total_cost
+          in zip(tasks, machine_times, costs["durationSeconds"], costs["duration"],
+                 costs["cpuCost"], costs["memoryCost"], costs["diskCost"], costs["totalCost"])]
+
+    def cost_cached_call(self, location, call, cost_task=None, reads=None):
+        """Cost of the call a cache hit reused, found in the workflow that ran it."""
+        cached_call, call_name, shard_index = parse_cache_result(call)
+        if reads is not None:
+            reads.add(cached_call)
+        call_data = self.metadata_cache.find_call(location, cached_call, call_name, shard_index)
+        return (cost_task or self.cost_task)(call_data)
+
+    def cost_workflow(self, location, workflow_id, cost_task=None, reads=None):
+        """
+        Determine the total cost of a workflow.
+
+        Returns total cost, call costs, and start/end time. cost_task is
+        used to cost each task run, or cache hit, in the workflow tree.
+        The ID of every workflow whose metadata is read is added to the
+        set reads, if given.
+        """
+        cost_task = cost_task or self.cost_task
+        if reads is not None:
+            reads.add(workflow_id)
+        metadata = self.metadata_cache.get(location, workflow_id)
+        call_costs_by_name = {}
+        for call_name, calls in metadata.get("calls", {}).items():
+            for call in calls:
+                ck = call_key(call_name, call)
+                kind = self.backend.call_kind(call)
+                if kind == TASK:
+                    call_costs_by_name[ck] = cost_task(call)
+                elif kind == CACHED:
+                    call_costs_by_name[ck] = self.cost_cached_call(location, call, cost_task, reads)
+                elif kind == SUBWORKFLOW:
+                    call_costs_by_name[ck] = self.cost_workflow(location, call[SUBWORKFLOW_KEY], cost_task, reads)
+                else:
+                    self.backend.log_skipped(call_name, ck)
+        duration = from_iso(metadata["end"]) - from_iso(metadata["start"])
+        def total(key):
+            return sum(call[key] for call in call_costs_by_name.values())
+        return {
+            "callCosts": call_costs_by_name,
+            "totalCost": total("totalCost"),
+            "diskCost": total("diskCost"),
+            "cpuCost": total("cpuCost"),
+            "memoryCost": total("memoryCost"),
+            "startTime": metadata["start"],
+            "endTime": metadata["end"],
+            "duration": str(duration),
+            "durationSeconds": "%.3f" % duration.total_seconds(),
+            "workflowId": workflow_id
+        }
+
+    def cost_workflow_vectorized(self, location, workflow_id, reads=None):
+        """
+        cost_workflow, costing every task in the workflow tree as one batch with cost_tasks.
+
+        The tree is walked once with a zero-cost placeholder for each
+        task. Placeholders are then filled in with the batch's results and
+        the totals recomputed. Requires numpy.
+        """
+        import cost_engine
+        tasks, placeholders = [], []
+
+        def collect(task):
+            tasks.append(task)
+            placeholders.append(dict(ZERO_COST))
+            return placeholders[-1]
+
+        workflow_cost = self.cost_workflow(location, workflow_id, cost_task=collect, reads=reads)
+        for placeholder, cost in zip(placeholders, self.cost_tasks(tasks)):
+            placeholder.clear()
+            placeholder.update(cost)
+        cost_engine.retotal(workflow_cost)
+        return workflow_cost
+
+    def saved_cost(self, store, location, workflow_id):
+        """
+        Cost of workflow_id saved in store, if it was costed by this
+        backend at the same prices from the same metadata, else None.
+        """
+        record = store.load(workflow_id)
+        if record is None or record["backend"] != type(self.backend).__name__ \
+                or record["prices"] != self.prices.fingerprint():
+            return None
+        for read_id, fingerprint in record["metadata"].items():
+            if metadata_fingerprint(location, read_id) != fingerprint:
+                return None
+        store.count(reused=True)
+        return record["cost"]
+
+    def cost_and_save(self, store, location, workflow_id, vectorized=False):
+        """Cost workflow_id, saving the cost in store for saved_cost to find later."""
+        reads = set()
+        if vectorized:
+            cost = self.cost_workflow_vectorized(location, workflow_id, reads=reads)
+        else:
+            cost = self.cost_workflow(location, workflow_id, reads=reads)
+        fingerprints = {read_id: metadata_fingerprint(location, read_id) for read_id in sorted(reads)}
+        if None in fingerprints.values():
+            logging.debug(f"Not saving cost of {workflow_id}, its metadata can't be fingerprinted")
+        else:
+            store.save(workflow_id, {"backend": type(self.backend).__name__,
+                                     "prices": self.prices.fingerprint(),
+                                     "metadata": fingerprints,
+                                     "cost": cost})
+        store.count(reused=False)
+        return cost
+
+    def cost_workflow_incremental(self, store, location, workflow_id, vectorized=False):
+        """
+        cost_workflow, reusing the cost saved in store by an earlier run
+        if none of the metadata it was costed from, or prices, changed since.
+        """
+        cost = self.saved_cost(store, location, workflow_id)
+        if cost is None:
+            cost = self.cost_and_save(store, location, workflow_id, vectorized)
+        return cost
+
+    def prefetch(self, location, workflow_ids, jobs):
+        """Load the metadata needed to cost workflow_ids on jobs processes, see metadata_cache.prefetch."""
+        prefetch(self.metadata_cache, location, workflow_ids, self.backend.referenced_workflows, jobs)
+
+
+def add_arguments(parser):
+    """Add the options every billing script shares to an ArgumentParser."""
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f"most workflows' metadata to keep parsed in memory. Default {DEFAULT_CACHE_SIZE}")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="load and parse metadata for the whole workflow tree up front on this many processes. "
+                        "At most --cache-size workflows are loaded this way.")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="parse metadata incrementally, keeping only what costing needs. Uses far less memory on huge workflows. Requires ijson.")
+    parser.add_argument("--vectorized", action="store_true", default=False,
+                        help="cost all tasks as one batch of arrays. Requires numpy.")
+    parser.add_argument("--prices",
+                        help="price catalog JSON or CSV file to cost with, see price_catalog.py. Defaults to the script's own prices.")
+    parser.add_argument("--incremental", metavar="COSTS_DIR",
+                        help="save workflow costs in this directory, and reuse those saved by earlier runs for workflows whose metadata and prices haven't changed.")
+    parser.add_argument("--parquet", metavar="DATASET_DIR",
+                        help="write task costs into a Parquet dataset partitioned by month and workflow, instead of to stdout. Requires pyarrow.")
+
+
+def configure(billing, args):
+    """Apply the options from add_arguments to billing."""
+    log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=log_level,
+        format='[%(levelname)s] %(message)s'
+    )
+
+    billing.metadata_cache.maxsize = args.cache_size
+    if args.prices:
+        billing.prices = price_catalog.PriceCatalog.load(args.prices)
+    if args.stream:
+        import metadata_stream
+        billing.metadata_cache.loader = partial(load_metadata, parse=metadata_stream.load_costing_fields)
+
+
+def main(billing, parser):
+    """Cost the one workflow named on the command line, as JSON or CSV to stdout."""
+    parser.add_argument("workflow_id")
+    parser.add_argument("metadata_dir")
+    parser.add_argument("--csv", action="store_true", default=False)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(billing, args)
+
+    location = args.metadata_dir.rstrip('/')
+    store = CostStore(args.incremental) if args.incremental else None
+    cost = store and billing.saved_cost(store, location, args.workflow_id)
+    if cost is None:
+        if args.jobs > 1:
+            billing.prefetch(location, [args.workflow_id], args.jobs)
+        if store:
+            cost = billing.cost_and_save(store, location, args.workflow_id, args.vectorized)
+        elif args.vectorized:
+            cost = billing.cost_workflow_vectorized(location, args.workflow_id)
+        else:
+            cost = billing.cost_workflow(location, args.workflow_id)
+    billing.metadata_cache.log_stats()
+    if store:
+        store.log_stats()
+    if args.parquet:
+        write_parquet(args.parquet, args.workflow_id, iter_task_costs(cost))
+    elif args.csv:
+        write_csv(sys.stdout, iter_task_costs(cost),
+                  fieldnames=task_fields(billing.backend.task_detail_fields()))
+    else:
+        print(json.dumps(cost, indent=4))
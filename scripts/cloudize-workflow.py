@@ -2,10 +2,16 @@
 import WDL as wdl  # https://miniwdl.readthedocs.io/en/latest/WDL.html#
 from ruamel.yaml import YAML
 # built-in, hooray
+import hashlib
 import json
 import logging
 import os
+import shutil
+import subprocess
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 from datetime import date
 from getpass import getuser
@@ -13,27 +19,288 @@ from pathlib import Path
 
 
 # TODO: if string type, wrap with quotes
-# IMPROVE: be able to drop and pick up the upload somehow.
-# long running process, may break near end
 
 UNIQUE_PATH = f"input_data/{getuser()}/" + date.today().strftime("%Y-%m-%d")
+DEFAULT_JOBS = 8
+DEFAULT_INDEX = f"{os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')}/cloudize/uploads.json"
 yaml = YAML()
 yaml.width = float("Infinity")  # prevent line wrapping
 yaml.preserve_quotes = True
 
 # ---- GCS interactions ------------------------------------------------
 
+def bucket_uri(bucket):
+    """Root URI to upload into for `bucket`.
+
+    Plain bucket names are GCS buckets. A local directory (absolute
+    path or file:// URI) can stand in for a bucket, which is handy for
+    trying out an upload without touching GCS.
+    """
+    if bucket.startswith("gs://") or bucket.startswith("file://") or os.path.isabs(bucket):
+        return bucket.rstrip("/")
+    else:
+        return f"gs://{bucket}"
+
+
+def copy_file(src, dest_uri):
+    """Copy local file src to dest_uri without clobbering. Returns True on success."""
+    if dest_uri.startswith("gs://"):
+        return subprocess.call(["gsutil", "-q", "cp", "-n", str(src), dest_uri]) == 0
+    else:
+        dest = Path(dest_uri[len("file://"):] if dest_uri.startswith("file://") else dest_uri)
+        os.makedirs(dest.parent, exist_ok=True)
+        if not dest.exists():
+            # copied alongside then renamed, so an interrupted copy never looks finished
+            tmp = dest.with_suffix(dest.suffix + ".tmp")
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dest)
+        return True
+
+
+def object_exists(uri):
+    if uri.startswith("gs://"):
+        return subprocess.call(["gsutil", "-q", "stat", uri],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    else:
+        return os.path.isfile(uri[len("file://"):] if uri.startswith("file://") else uri)
+
+
 def upload_to_gcs(bucket, src, dest, dryrun=False):
-    """Upload a local file to GCS bucket. src is a filepath and dest is target GCS name."""
-    gcs_uri = f"gs://{bucket}/{dest}"
+    """Upload a local file to GCS bucket. src is a filepath and dest is target GCS name.
+
+    Returns one of "uploaded", "failed", "skipped", or "dryrun".
+    """
+    gcs_uri = f"{bucket_uri(bucket)}/{dest}"
     if os.path.isdir(src):
         logging.info(f"Source file {src} is a directory. Skipping.")
+        return "skipped"
     elif not os.path.isfile(src):
         logging.warning(f"could not find source file, potentially just a basepath: {src}")
+        return "skipped"
     elif dryrun:
-        pass
+        return "dryrun"
     else:
-        os.system(f"gsutil cp -n {src} {gcs_uri}")
+        return "uploaded" if copy_file(src, gcs_uri) else "failed"
+
+
+# ---- Upload engine ---------------------------------------------------
+
+class UploadManifest:
+    """Checkpoint of finished uploads, stored as one JSON record per line.
+
+    Records are appended as each upload completes, keyed by source
+    file, so an interrupted run can be restarted and will point files
+    already recorded at the objects they were uploaded to. This works
+    even on a later day, when new uploads would go under a different
+    path. A record only counts if the source file still has the same
+    size and mtime it had when uploaded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # partial line from an interrupted write
+                        continue
+                    self.completed[record["src"]] = record
+
+    def uploaded_uri(self, src, root):
+        """URI src was uploaded to under bucket URI root, if it hasn't changed since, else None."""
+        record = self.completed.get(str(src))
+        if not record or not record["uri"].startswith(root + "/") or not os.path.isfile(src):
+            return None
+        stat = os.stat(src)
+        if record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+            return record["uri"]
+        return None
+
+    def record(self, result, uri):
+        stat = os.stat(result.src)
+        record = {"src": str(result.src), "uri": uri,
+                  "size": stat.st_size, "mtime": stat.st_mtime,
+                  "seconds": round(result.seconds, 3)}
+        with self._lock:
+            self.completed[str(result.src)] = record
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+def file_md5(path, chunk_size=2**20):
+    """Streaming MD5 of a file's contents, as hex."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class UploadIndex:
+    """Content-addressed record of files uploaded by previous runs.
+
+    Maps the MD5 of a file's contents to the URIs of objects already
+    holding those contents, so a file seen before can point at such an
+    object instead of being uploaded again. Only objects in the bucket
+    being uploaded to are reused, since whoever runs the workflow may
+    not be able to read other buckets. Objects are only reused for
+    files of the same name, since tasks often rely on file names and
+    extensions, so the same contents under another name are uploaded
+    again. Checksums are remembered
+    against each local file's size and mtime, so an unchanged file is
+    only read once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.objects = {}
+        self.checksums = {}
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                contents = json.load(f)
+            # older indexes held a single object per checksum
+            self.objects = {md5: entries if isinstance(entries, list) else [entries]
+                            for md5, entries in contents.get("objects", {}).items()}
+            self.checksums = contents.get("checksums", {})
+
+    def known_checksum(self, local):
+        """Checksum of local from a previous run, if it hasn't changed since."""
+        entry = self.checksums.get(str(local))
+        stat = os.stat(local)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["md5"]
+        return None
+
+    def set_checksum(self, local, md5):
+        stat = os.stat(local)
+        self.checksums[str(local)] = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": md5}
+
+    def checksum(self, local):
+        md5 = self.known_checksum(local)
+        if md5 is None:
+            md5 = file_md5(local)
+            self.set_checksum(local, md5)
+        return md5
+
+    def lookup(self, md5, size, root, name=None):
+        """URI of an indexed object under bucket URI root with these contents, or None.
+
+        If name is given, only objects with that basename are considered.
+        """
+        for entry in self.objects.get(md5, []):
+            if (entry["size"] == size and entry["uri"].startswith(root + "/")
+                    and (name is None or entry["uri"].rsplit("/", 1)[1] == name)):
+                return entry["uri"]
+        return None
+
+    def add(self, local, uri):
+        entries = self.objects.setdefault(self.checksum(local), [])
+        entries[:] = [entry for entry in entries if entry["uri"] != uri]
+        entries.append({"uri": uri, "size": os.path.getsize(local)})
+
+    def save(self):
+        os.makedirs(Path(self.path).parent, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"objects": self.objects, "checksums": self.checksums}, f)
+        os.replace(tmp, self.path)
+
+
+def find_existing_upload(index, local, md5, root):
+    """URI of a live object under bucket URI root with the same name and contents as local, or None."""
+    uri = index.lookup(md5, os.path.getsize(local), root, name=Path(local).name)
+    if uri and not object_exists(uri):
+        logging.debug(f"Indexed object {uri} no longer exists, forgetting it")
+        return None
+    return uri
+
+
+def reuse_existing_uploads(file_inputs, index, bucket, jobs=DEFAULT_JOBS):
+    """Point file inputs at objects uploaded to `bucket` by earlier runs, where possible.
+
+    Checksums are computed concurrently. Only objects with the same
+    basename as the local file are reused, so identical contents under
+    another name are uploaded again. A FileInput with secondary files
+    is only redirected when every one of its files was found in the
+    same directory, since workflows expect secondary files to sit
+    alongside their primary file.
+    Mutates the FilePaths of redirected inputs, returning how many files
+    won't need uploading.
+    """
+    root = bucket_uri(bucket)
+    local_files = {file_path.local for f in file_inputs for file_path in f.all_file_paths
+                   if os.path.isfile(file_path.local)}
+    unknown = [local for local in local_files if index.known_checksum(local) is None]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for local, md5 in zip(unknown, pool.map(file_md5, unknown)):
+            index.set_checksum(local, md5)
+        checked = list(local_files)
+        existing = dict(zip(checked, pool.map(
+            lambda local: find_existing_upload(index, local, index.known_checksum(local), root),
+            checked)))
+
+    reused = 0
+    for f in file_inputs:
+        uris = [existing.get(file_path.local) for file_path in f.all_file_paths]
+        if not all(uris) or all(file_path.existing for file_path in f.all_file_paths):
+            continue
+        parents = {uri.rsplit("/", 1)[0] for uri in uris}
+        if len(parents) == 1:
+            for uri, file_path in zip(uris, f.all_file_paths):
+                logging.info(f"Reusing {uri} for {file_path.local}")
+                file_path.existing = uri
+            reused += len(uris)
+    return reused
+
+
+def resume_uploads(file_inputs, manifest, bucket):
+    """Point file inputs at the objects an interrupted run already uploaded them to.
+
+    As with reuse_existing_uploads, a FileInput with secondary files is
+    only redirected when every one of its files was recorded, so they
+    stay together. Mutates the FilePaths of redirected inputs, returning
+    how many files won't need uploading.
+    """
+    root = bucket_uri(bucket)
+    resumed = 0
+    for f in file_inputs:
+        uris = [manifest.uploaded_uri(file_path.local, root) for file_path in f.all_file_paths]
+        if all(uris):
+            for uri, file_path in zip(uris, f.all_file_paths):
+                file_path.existing = uri
+            resumed += len(uris)
+    return resumed
+
+
+class UploadResult:
+    def __init__(self, src, dest, status, size, seconds):
+        self.src = src
+        self.dest = dest
+        self.status = status
+        self.size = size
+        self.seconds = seconds
+
+    def mib_per_second(self):
+        return (self.size / 2**20) / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return f"UploadResult(src=\"{self.src}\", status=\"{self.status}\")"
+
+
+def upload_one(bucket, src, dest, dryrun=False):
+    """Upload a single file, timing it. Returns an UploadResult."""
+    start = time.monotonic()
+    status = upload_to_gcs(bucket, src, dest, dryrun=dryrun)
+    seconds = time.monotonic() - start
+    size = os.path.getsize(src) if status == "uploaded" else 0
+    if status == "uploaded":
+        logging.info(f"Uploaded {src} ({size / 2**20:.1f} MiB in {seconds:.1f}s, "
+                     f"{size / 2**20 / max(seconds, 1e-6):.1f} MiB/s)")
+    elif status == "failed":
+        logging.error(f"Failed to upload {src} to {dest}")
+    return UploadResult(src, dest, status, size, seconds)
 
 
 # ---- Generic functions -----------------------------------------------
@@ -234,10 +501,15 @@ class FilePath:
     def __init__(self, local):
         self.local = local
         self.cloud = None
+        self.existing = None
 
     def set_cloud(self, cloud):
         self.cloud = f"{UNIQUE_PATH}/{cloud}"
 
+    def uri(self, bucket):
+        """Where this file lives in the cloud: an existing object if reused, else its upload target."""
+        return self.existing or f"{bucket_uri(bucket)}/{self.cloud}"
+
     def __repr__(self):
         return f"FilePath(\"{str(self.local)}\")"
 
@@ -266,7 +538,7 @@ def set_cloud_paths(file_inputs):
 def cloudize_file_paths(inputs, bucket, file_inputs):
     new_input_obj = deepcopy(inputs) or {}
     for f in file_inputs:
-        set_in(new_input_obj, f.input_path, str(f"gs://{bucket}/{f.file_path.cloud}"))
+        set_in(new_input_obj, f.input_path, f.file_path.uri(bucket))
     return new_input_obj
 
 
@@ -280,15 +552,52 @@ def write_new_inputs(new_input_obj, output_path):
     logging.info(f"Inputs dumped to {output_path}")
 
 
-def upload_all(file_inputs, bucket, dryrun):
-    # Upload all the files
-    # TODO: find a way to optimize/parallelize a la `gsutil -m
+def upload_all(file_inputs, bucket, dryrun, jobs=DEFAULT_JOBS, manifest=None, index=None):
+    """Upload every file of file_inputs using a pool of `jobs` workers.
+
+    Each finished upload is recorded in the UploadManifest, if given, so
+    rerunning after an interruption resumes where the last run stopped,
+    see resume_uploads. Files redirected to an existing object are not
+    uploaded at all. If an UploadIndex is given, every uploaded file is
+    added to it. Returns the UploadResult of every attempted upload.
+    """
+    uploads = {}
     for f in file_inputs:
         for file_path in f.all_file_paths:
-            upload_to_gcs(bucket, file_path.local, file_path.cloud, dryrun=dryrun)
-
-
-def cloudize(bucket, wf_path, inputs_path, output_path, dryrun=False):
+            if not file_path.existing:
+                uploads[file_path.cloud] = file_path.local
+    pending = [(src, dest) for dest, src in uploads.items()]
+
+    results = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(upload_one, bucket, src, dest, dryrun) for src, dest in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            if result.status == "uploaded":
+                if manifest:
+                    manifest.record(result, f"{bucket_uri(bucket)}/{result.dest}")
+                if index:
+                    index.add(result.src, f"{bucket_uri(bucket)}/{result.dest}")
+            results.append(result)
+    elapsed = time.monotonic() - start
+
+    uploaded = [r for r in results if r.status == "uploaded"]
+    total_mib = sum(r.size for r in uploaded) / 2**20
+    logging.info(f"Uploaded {len(uploaded)} files, {total_mib:.1f} MiB in {elapsed:.1f}s "
+                 f"({total_mib / max(elapsed, 1e-6):.1f} MiB/s with {jobs} workers)")
+    if uploaded:
+        slowest = min(uploaded, key=lambda r: r.mib_per_second())
+        logging.debug(f"Slowest upload {slowest.src} at {slowest.mib_per_second():.1f} MiB/s")
+    return results
+
+
+def default_manifest(output_path):
+    return f"{output_path.parent}/{output_path.stem}_uploads.jsonl"
+
+
+def cloudize(bucket, wf_path, inputs_path, output_path, dryrun=False,
+             jobs=DEFAULT_JOBS, manifest_path=None, index_path=DEFAULT_INDEX):
     """Generate a cloud version of an inputs YAML file provided that file
     and its workflow's CWL definition."""
     workflow = make_workflow(wf_path, inputs_path)
@@ -300,9 +609,32 @@ def cloudize(bucket, wf_path, inputs_path, output_path, dryrun=False):
         exit()
 
     set_cloud_paths(file_inputs)
+    manifest_path = manifest_path or default_manifest(output_path)
+    manifest = UploadManifest(manifest_path)
+    resumed = resume_uploads(file_inputs, manifest, bucket)
+    if resumed:
+        logging.info(f"Resuming upload, {resumed} files already recorded in {manifest_path}")
+    index = UploadIndex(index_path) if index_path else None
+    if index and not dryrun:
+        for f in file_inputs:
+            for file_path in f.all_file_paths:
+                if file_path.existing:
+                    index.add(file_path.local, file_path.existing)
+    if index:
+        reused = reuse_existing_uploads(file_inputs, index, bucket, jobs=jobs)
+        logging.info(f"{reused} files already uploaded by earlier runs, reusing them")
     cloudized_inputs = cloudize_file_paths(workflow.inputs, bucket, file_inputs)
     write_new_inputs(cloudized_inputs, output_path)
-    upload_all(file_inputs, bucket, dryrun)
+    try:
+        results = upload_all(file_inputs, bucket, dryrun, jobs=jobs, manifest=manifest, index=index)
+    finally:
+        if index and not dryrun:
+            index.save()
+    failed = [r for r in results if r.status == "failed"]
+    if failed:
+        logging.error(f"{len(failed)} uploads failed. Rerun the same command to retry them; "
+                      "completed uploads will be skipped.")
+        exit(1)
     logging.info("Completed file upload process.")
 
 
@@ -318,7 +650,8 @@ if __name__ == "__main__":
 Upload File inputs and generate new workflow_inputs file.""")
 
     parser.add_argument("bucket",
-                        help="the name of the GCS bucket to upload workflow inputs")
+                        help="""the name of the GCS bucket to upload workflow inputs.
+A local directory path may be given instead to stand in for a bucket.""")
     parser.add_argument("workflow_definition",
                         help="path to the .cwl file defining your workflow")
     parser.add_argument("workflow_inputs",
@@ -329,6 +662,19 @@ Defaults to workflow_inputs with _cloud before the extension.
 If this value ends with .json, JSON format used instead of YAML.""")
 
     parser.add_argument("--dryrun", help="prevent actual upload to GCS.")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help=f"number of files to upload concurrently. Default {DEFAULT_JOBS}.")
+    parser.add_argument("--manifest",
+                        help="""Path of the upload checkpoint manifest. Rerunning with the same
+manifest points files already uploaded at the objects recorded there, even on a
+later day, instead of uploading them again. Defaults to the output path with _uploads.jsonl
+in place of its extension.""")
+    parser.add_argument("--index", default=DEFAULT_INDEX,
+                        help=f"""Path of the index of previously uploaded file contents.
+Files whose contents were uploaded before are pointed at the existing object instead
+of being uploaded again. Default {DEFAULT_INDEX}.""")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="upload every file, ignoring and not updating the upload index.")
     args = parser.parse_args()
 
     log_level = os.environ.get("LOGLEVEL", "INFO").upper()
@@ -342,5 +688,8 @@ If this value ends with .json, JSON format used instead of YAML.""")
         Path(args.workflow_definition),
         Path(args.workflow_inputs),
         Path(args.output or default_output(args.workflow_inputs)),
-        dryrun=args.dryrun
+        dryrun=args.dryrun,
+        jobs=args.jobs,
+        manifest_path=args.manifest,
+        index_path=None if args.no_dedup else args.index
     )
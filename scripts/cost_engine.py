@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+SECONDS_PER_HOUR = 60 * 60
+SECONDS_PER_MONTH = 30 * 24 * SECONDS_PER_HOUR
+
+
+def _from_iso(datetime_str):
+    return datetime.fromisoformat(datetime_str.rstrip('Z'))
+
+
+def duration_microseconds(starts, ends):
+    """
+    Microseconds between each pair of ISO 8601 timestamps, as an int64 array.
+
+    Timestamps are parsed in bulk by numpy. Should any carry a UTC
+    offset, which numpy won't parse, all are parsed with datetime instead.
+    """
+    try:
+        start = np.array([s.rstrip('Z') for s in starts], dtype="datetime64[us]")
+        end = np.array([e.rstrip('Z') for e in ends], dtype="datetime64[us]")
+        return (end - start).astype(np.int64)
+    except ValueError:
+        return np.array([(_from_iso(e) - _from_iso(s)) // timedelta(microseconds=1)
+                         for s, e in zip(starts, ends)], dtype=np.int64)
+
+
+def cost_tasks(starts, ends, vcpus, memory_gb, disk_gb, cpu_price, memory_price, disk_price):
+    """
+    Cost many tasks at once. Each argument holds one value per task.
+
+    starts and ends are when the task's machine started and stopped,
+    as ISO 8601 timestamps. Prices are per vCPU hour, per GB hour, and
+    per GB month respectively. Machines are charged for at least a
+    minute; disks are charged by the second.
+
+    Performs the same arithmetic, in the same order, as costing each
+    task on its own, so results match to the last bit. Returns a dict
+    of lists, one entry per task: durationSeconds, duration (as a
+    timedelta), cpuCost, memoryCost, diskCost, and totalCost.
+    """
+    microseconds = duration_microseconds(starts, ends)
+    seconds = microseconds / 10**6
+    billable_seconds = np.maximum(60, seconds)
+    cpu = billable_seconds * np.asarray(vcpus, dtype=np.float64) \
+        * np.asarray(cpu_price, dtype=np.float64) / SECONDS_PER_HOUR
+    memory = billable_seconds * np.asarray(memory_gb, dtype=np.float64) \
+        * np.asarray(memory_price, dtype=np.float64) / SECONDS_PER_HOUR
+    disk = seconds * np.asarray(disk_gb, dtype=np.float64) \
+        * np.asarray(disk_price, dtype=np.float64) / SECONDS_PER_MONTH
+    total = cpu + memory + disk
+    return {
+        "durationSeconds": seconds.tolist(),
+        "duration": [timedelta(microseconds=us) for us in microseconds.tolist()],
+        "cpuCost": cpu.tolist(),
+        "memoryCost": memory.tolist(),
+        "diskCost": disk.tolist(),
+        "totalCost": total.tolist(),
+    }
+
+
+def retotal(workflow_cost):
+    """
+    Recompute the cost totals of a workflow cost, and of its
+    subworkflows, from its call costs. Mutates workflow_cost.
+    """
+    call_costs = workflow_cost["callCosts"]
+    for call_cost in call_costs.values():
+        if "callCosts" in call_cost:
+            retotal(call_cost)
+    for key in ["totalCost", "diskCost", "cpuCost", "memoryCost"]:
+        workflow_cost[key] = sum(call[key] for call in call_costs.values())
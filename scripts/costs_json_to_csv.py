@@ -1,38 +1,166 @@
 import json
 import csv
+import logging
+import shutil
 import sys
 
 from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from itertools import chain
 from pathlib import Path
 
 
-def task_costs(workflow_cost):
-    # iterate through callCosts, nesting until it bottoms out.
-    # Depth first, to do least huge duplications first
-    # convert innermost object to a line, include name and include path there in some fashion
-    call_frontier = list(workflow_cost["callCosts"].items())
-    entries = []
+# Every column a task row has, in order, whichever billing script
+# made it. Backend specific details, e.g. PAPI's machineType, go after
+# machineEndTime, see task_fields.
+TASK_FIELDS = ["callName", "durationSeconds", "duration", "startTime", "endTime",
+               "machineStartTime", "machineEndTime",
+               "memoryCost", "cpuCost", "diskCost", "disks", "totalCost",
+               "attempt", "preemptible", "backendStatus",
+               "workflowPath", "subworkflowId"]
+
+# Every backend specific detail a task row can have
+TASK_DETAIL_FIELDS = ["machineType"]
+
+
+def task_fields(details=()):
+    """TASK_FIELDS with a backend's detail columns in place, see billing.Backend.task_detail_fields."""
+    at = TASK_FIELDS.index("machineEndTime") + 1
+    return [*TASK_FIELDS[:at], *details, *TASK_FIELDS[at:]]
+
+
+def iter_task_costs(workflow_cost):
+    """
+    Yield a row for each task in a workflow cost, flattening subworkflows.
+
+    Depth first, in the same order as task_costs always has. Each row
+    is the task's costs, plus its call name, the call names of the
+    subworkflows it is nested in joined by "/" as workflowPath, and the
+    ID of the subworkflow it ran in, both empty for root workflow tasks.
+    """
+    call_frontier = [("", "", call_name, call_costs)
+                     for call_name, call_costs in workflow_cost["callCosts"].items()]
     while call_frontier:
-        call_name, call_costs = call_frontier.pop()
+        path, workflow_id, call_name, call_costs = call_frontier.pop()
         if "callCosts" in call_costs:  # call is a workflow, not a task
-            call_frontier.extend(call_costs["callCosts"].items())
+            subpath = f"{path}/{call_name}" if path else call_name
+            call_frontier.extend((subpath, call_costs["workflowId"], name, costs)
+                                 for name, costs in call_costs["callCosts"].items())
         else:  # call is a task
-            entries.append({"callName": call_name, **call_costs})
-    return entries
+            yield {"callName": call_name, **call_costs, "workflowPath": path, "subworkflowId": workflow_id}
+
+
+def task_costs(workflow_cost):
+    return list(iter_task_costs(workflow_cost))
+
+
+def write_csv(fp, rows, fieldnames=None):
+    """
+    Stream rows to fp as CSV with the given columns, writing the header
+    with the first row. Values missing from a row are left empty, and
+    keys not in fieldnames are dropped with a warning.
+
+    Without fieldnames, the first row's keys are the columns.
+    """
+    writer = None
+    dropped = set()
+    for row in rows:
+        if writer is None:
+            if fieldnames is None:
+                fieldnames = list(row.keys())
+            writer = csv.DictWriter(fp, fieldnames=fieldnames, restval="", extrasaction="ignore",
+                                    lineterminator='\n')
+            writer.writeheader()
+        extra = row.keys() - writer.fieldnames - dropped
+        if extra:
+            logging.warning(f"Dropping columns not in the CSV schema: {', '.join(sorted(extra))}")
+            dropped |= extra
+        writer.writerow(row)
+
+
+def write_task_csv(fp, rows):
+    """Stream task rows to fp as CSV, with whichever TASK_DETAIL_FIELDS the first row has."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is not None:
+        write_csv(fp, chain([first], rows),
+                  fieldnames=task_fields([field for field in TASK_DETAIL_FIELDS if field in first]))
+
+
+# Parquet columns of each task_fields(TASK_DETAIL_FIELDS) column, by type, plus workflowId and month partitions
+PARQUET_TIMESTAMP_FIELDS = ["startTime", "endTime", "machineStartTime", "machineEndTime"]
+PARQUET_FLOAT_FIELDS = ["durationSeconds", "memoryCost", "cpuCost", "diskCost", "totalCost"]
+PARQUET_PARTITIONS = ["month", "workflowId"]
+
+
+def _from_iso(datetime_str):
+    return datetime.fromisoformat(datetime_str.rstrip('Z')) if datetime_str else None
+
+
+def parquet_table(workflow_id, rows):
+    """
+    Task rows of one root workflow as a typed pyarrow Table.
+
+    Times are UTC timestamps, duration a duration, costs floats, and
+    attempt and preemptible an int and bool. month is the YYYY-MM each
+    task started in. Requires pyarrow.
+    """
+    import pyarrow as pa
+    rows = list(rows)
+
+    def column(field):
+        return [row.get(field) for row in rows]
+
+    columns = {"workflowId": pa.array([workflow_id] * len(rows), pa.string())}
+    for field in task_fields(TASK_DETAIL_FIELDS):
+        if field in PARQUET_TIMESTAMP_FIELDS:
+            columns[field] = pa.array([_from_iso(value) for value in column(field)], pa.timestamp("us", tz="UTC"))
+        elif field in PARQUET_FLOAT_FIELDS:
+            columns[field] = pa.array(column(field), pa.float64())
+        elif field == "duration":
+            columns[field] = pa.array([None if seconds is None else timedelta(seconds=seconds)
+                                       for seconds in column("durationSeconds")], pa.duration("us"))
+        elif field == "attempt":
+            columns[field] = pa.array(column(field), pa.int64())
+        elif field == "preemptible":
+            columns[field] = pa.array(column(field), pa.bool_())
+        else:
+            columns[field] = pa.array([None if value is None else str(value) for value in column(field)],
+                                      pa.string())
+    columns["month"] = pa.array([(row.get("startTime") or "")[:7] for row in rows], pa.string())
+    return pa.table(columns)
+
 
+def write_parquet(root, workflow_id, rows):
+    """
+    Write one root workflow's task rows into a Parquet dataset at root.
 
-def write_csv(fp, results_dict):
-    if results_dict:
-        writer = csv.DictWriter(fp, fieldnames=results_dict[0].keys(), lineterminator='\n')
-        writer.writeheader()
-        writer.writerows(results_dict)
+    The dataset is partitioned as month=YYYY-MM/workflowId=<id>/, and
+    a workflow's files are replaced if it is written again, so costs can
+    be re-exported into the same dataset. Its files in every month are
+    removed first, in case its tasks' months have changed. Requires pyarrow.
+    """
+    import pyarrow.parquet as pq
+    table = parquet_table(workflow_id, rows)
+    for partition in Path(root).glob(f"month=*/workflowId={workflow_id}"):
+        shutil.rmtree(partition)
+        if not any(partition.parent.iterdir()):
+            partition.parent.rmdir()
+    if table.num_rows:
+        pq.write_to_dataset(table, root, partition_cols=PARQUET_PARTITIONS,
+                            basename_template=f"{workflow_id}-{{i}}.parquet",
+                            existing_data_behavior="delete_matching")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Convert output of estimate_billing.py, a JSON containing billing information for a workflow, into a CSV format.")
     parser.add_argument("input_file")
+    parser.add_argument("--parquet", metavar="DATASET_DIR",
+                        help="write task costs into a Parquet dataset partitioned by month and workflow, instead of CSV to stdout. Requires pyarrow.")
     args = parser.parse_args()
 
     costs_json = json.loads(Path(args.input_file).read_text())
-    results = task_costs(costs_json)
-    write_csv(sys.stdout, results)
+    if args.parquet:
+        write_parquet(args.parquet, costs_json["workflowId"], iter_task_costs(costs_json))
+    else:
+        write_task_csv(sys.stdout, iter_task_costs(costs_json))
@@ -0,0 +1,172 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+
+DEFAULT_CACHE_SIZE = 32
+
+# The only parts of workflow metadata used for costing, and by rightsize.py
+COSTING_WORKFLOW_KEYS = {"id", "workflowName", "status", "start", "end", "calls",
+                         "parentWorkflowId", "rootWorkflowId"}
+COSTING_CALL_KEYS = {"executionStatus", "backendStatus", "shardIndex", "attempt", "start", "end",
+                     "preemptible", "executionEvents", "runtimeAttributes", "jes",
+                     "callCaching", "subWorkflowId", "monitoringLog"}
+
+
+class MetadataCache:
+    """
+    Size-bounded LRU cache of parsed workflow metadata, shared by the billing scripts.
+
+    Entries are keyed by metadata location and workflow ID. On a miss,
+    `loader(location, workflow_id)` is called to read and parse the
+    metadata, and only its workflow fields and `call_keys` call fields
+    are kept, see costing_fields, so an entry is far smaller than the
+    document it came from. Once more than `maxsize` workflows are held,
+    the least recently used is dropped. Safe to share between threads.
+    """
+    def __init__(self, loader, maxsize=DEFAULT_CACHE_SIZE, call_keys=COSTING_CALL_KEYS):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.call_keys = set(call_keys)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._call_indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, location, workflow_id):
+        key = (location, workflow_id)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        metadata = costing_fields(self.loader(location, workflow_id), self.call_keys)
+        self.put(location, workflow_id, metadata)
+        return metadata
+
+    def put(self, location, workflow_id, metadata):
+        with self._lock:
+            self._entries[(location, workflow_id)] = metadata
+            self._entries.move_to_end((location, workflow_id))
+            while len(self._entries) > self.maxsize:
+                evicted, _ = self._entries.popitem(last=False)
+                self._call_indexes.pop(evicted, None)
+
+    def find_call(self, location, workflow_id, call_name, shard_index):
+        """
+        The first call named call_name with shard_index in a workflow.
+
+        Looked up through an index of the workflow's calls built the
+        first time it's needed, rather than scanning the calls each time.
+        """
+        metadata = self.get(location, workflow_id)
+        with self._lock:
+            indexed, index = self._call_indexes.get((location, workflow_id), (None, None))
+        if indexed is not metadata:
+            index = {}
+            for name, calls in metadata["calls"].items():
+                for call in calls:
+                    index.setdefault((name, call["shardIndex"]), call)
+            with self._lock:
+                self._call_indexes[(location, workflow_id)] = (metadata, index)
+        return index[(call_name, shard_index)]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def log_stats(self):
+        logging.info(f"Metadata cache: {self.hits} hits, {self.misses} misses, "
+                     f"{len(self)} of max {self.maxsize} workflows held")
+
+
+def costing_fields(metadata, call_keys=COSTING_CALL_KEYS):
+    """Copy of metadata with only the fields needed for costing, and the call fields in call_keys."""
+    pruned = {k: v for k, v in metadata.items() if k in COSTING_WORKFLOW_KEYS}
+    pruned["calls"] = {call_name: [{k: v for k, v in call.items() if k in call_keys}
+                                   for call in calls]
+                       for call_name, calls in metadata.get("calls", {}).items()}
+    return pruned
+
+
+def _load_for_costing(loader, call_keys, referenced_workflows, location, workflow_id, follow):
+    metadata = costing_fields(loader(location, workflow_id), call_keys)
+    return metadata, (referenced_workflows(metadata) if follow else ([], []))
+
+
+def prefetch(cache, location, workflow_ids, referenced_workflows, jobs):
+    """
+    Load the metadata of workflow_ids and every workflow needed to cost them into cache, in parallel.
+
+    Metadata is read and parsed on a pool of `jobs` processes, since
+    parsing JSON is CPU bound. Only the fields needed for costing are
+    sent back and cached. `referenced_workflows(metadata)` must return
+    (subworkflow IDs, cached call workflow IDs); subworkflows are
+    followed, while cached call workflows are loaded but not crawled.
+    Both it and the cache's loader must be picklable, e.g.
+    module-level functions or methods of a billing.Backend.
+
+    At most the cache's maxsize workflows are prefetched; once that many
+    have been loaded, the rest are left to be loaded as costing needs
+    them, so the cache stays within its bound. A workflow first seen as
+    a cached call and later as a subworkflow is crawled after all.
+    """
+    requested = {}  # workflow ID -> whether its references are followed
+    loaded = {}
+    skipped = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+
+        def follow(metadata):
+            subworkflow_ids, cached_ids = referenced_workflows(metadata)
+            for subworkflow_id in subworkflow_ids:
+                request(subworkflow_id, True)
+            for cached_id in cached_ids:
+                request(cached_id, False)
+
+        def request(workflow_id, follows):
+            if workflow_id in requested:
+                if follows and not requested[workflow_id]:
+                    requested[workflow_id] = True
+                    if workflow_id in loaded:
+                        follow(loaded[workflow_id])
+                return
+            if len(requested) >= cache.maxsize:
+                skipped.add(workflow_id)
+                return
+            requested[workflow_id] = follows
+            future = pool.submit(_load_for_costing, cache.loader, cache.call_keys, referenced_workflows,
+                                 location, workflow_id, follows)
+            future.workflow_id = workflow_id
+            future.follows = follows
+            pending.add(future)
+
+        for workflow_id in dict.fromkeys(workflow_ids):
+            request(workflow_id, True)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending.difference_update(done)
+            for future in done:
+                metadata, (subworkflow_ids, cached_ids) = future.result()
+                workflow_id = future.workflow_id
+                cache.put(location, workflow_id, metadata)
+                loaded[workflow_id] = metadata
+                if future.follows:
+                    for subworkflow_id in subworkflow_ids:
+                        request(subworkflow_id, True)
+                    for cached_id in cached_ids:
+                        request(cached_id, False)
+                elif requested[workflow_id]:  # became a subworkflow while loading
+                    follow(metadata)
+    skipped.difference_update(requested)
+    logging.info(f"Prefetched metadata for {len(loaded)} workflows with {jobs} processes")
+    if skipped:
+        logging.warning(f"Metadata cache size {cache.maxsize} limits prefetching: {len(skipped)} more workflows "
+                        f"will be loaded one at a time as costing needs them. Raise --cache-size to at least "
+                        f"{cache.maxsize + len(skipped)} to load them all in parallel")
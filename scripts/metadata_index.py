@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+
+INDEX_SUFFIXES = (".sqlite", ".db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workflows (
+    workflow_id TEXT PRIMARY KEY,
+    workflow_name TEXT,
+    status TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    parent_workflow_id TEXT,
+    root_workflow_id TEXT,
+    source_size INTEGER,
+    source_mtime REAL
+);
+CREATE TABLE IF NOT EXISTS calls (
+    workflow_id TEXT NOT NULL,
+    call_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    shard_index INTEGER,
+    attempt INTEGER,
+    execution_status TEXT,
+    backend_status TEXT,
+    preemptible INTEGER,
+    start_time TEXT,
+    end_time TEXT,
+    execution_events TEXT,
+    runtime_attributes TEXT,
+    jes TEXT,
+    call_caching TEXT,
+    cache_hit INTEGER,
+    cached_workflow_id TEXT,
+    subworkflow_id TEXT,
+    PRIMARY KEY (workflow_id, call_name, position)
+);
+CREATE INDEX IF NOT EXISTS calls_by_cached_workflow ON calls (cached_workflow_id);
+CREATE INDEX IF NOT EXISTS calls_by_subworkflow ON calls (subworkflow_id);
+"""
+
+# JSON-valued call fields, by metadata key and column
+JSON_CALL_FIELDS = [("executionEvents", "execution_events"),
+                    ("runtimeAttributes", "runtime_attributes"),
+                    ("jes", "jes"),
+                    ("callCaching", "call_caching")]
+# Plain call fields, by metadata key and column
+CALL_FIELDS = [("shardIndex", "shard_index"),
+               ("attempt", "attempt"),
+               ("executionStatus", "execution_status"),
+               ("backendStatus", "backend_status"),
+               ("start", "start_time"),
+               ("end", "end_time"),
+               ("subWorkflowId", "subworkflow_id")]
+
+_connections = threading.local()
+
+
+def is_index(location):
+    """Whether location names a metadata index rather than a directory of metadata files."""
+    return str(location).endswith(INDEX_SUFFIXES)
+
+
+def connect(index_path):
+    """Connection to the index at index_path, one per thread, creating tables as needed."""
+    connections = _connections.__dict__.setdefault("by_path", {})
+    # keyed by process too, since forked worker processes must not reuse a parent's connection
+    key = (os.getpid(), index_path)
+    if key not in connections:
+        connection = sqlite3.connect(index_path)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        connections[key] = connection
+    return connections[key]
+
+
+def cached_workflow_id(call):
+    """ID of the workflow a cache hit call was copied from, or None."""
+    caching = call.get("callCaching", {})
+    result = caching.get("result", "")
+    if caching.get("hit") is True and result.startswith("Cache Hit: "):
+        return result[len("Cache Hit: "):].split(":")[0]
+    return None
+
+
+def call_row(workflow_id, call_name, position, call):
+    row = {"workflow_id": workflow_id, "call_name": call_name, "position": position}
+    for key, column in CALL_FIELDS:
+        row[column] = call.get(key)
+    for key, column in JSON_CALL_FIELDS:
+        row[column] = json.dumps(call[key]) if key in call else None
+    row["preemptible"] = None if "preemptible" not in call else int(call["preemptible"])
+    row["cache_hit"] = int(call.get("callCaching", {}).get("hit") is True)
+    row["cached_workflow_id"] = cached_workflow_id(call)
+    return row
+
+
+def add_workflow(connection, metadata, source_size=None, source_mtime=None):
+    """Replace the index's rows for a workflow with those from its metadata."""
+    workflow_id = metadata["id"]
+    connection.execute("DELETE FROM calls WHERE workflow_id = ?", (workflow_id,))
+    connection.execute(
+        "INSERT OR REPLACE INTO workflows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (workflow_id, metadata.get("workflowName"), metadata.get("status"),
+         metadata.get("start"), metadata.get("end"),
+         metadata.get("parentWorkflowId"), metadata.get("rootWorkflowId"),
+         source_size, source_mtime))
+    rows = [call_row(workflow_id, call_name, position, call)
+            for call_name, calls in metadata.get("calls", {}).items()
+            for position, call in enumerate(calls)]
+    if rows:
+        columns = list(rows[0].keys())
+        connection.executemany(
+            f"INSERT INTO calls ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [[row[column] for column in columns] for row in rows])
+
+
+def ingest(metadata_dir, index_path):
+    """
+    Load every <workflow_id>.json file in metadata_dir into the index at index_path.
+
+    Files whose size and mtime match what was ingested last time are
+    skipped, so re-running after new workflows have been persisted
+    only parses the new files. Returns the number of files ingested.
+    """
+    connection = connect(index_path)
+    known = {row["workflow_id"]: (row["source_size"], row["source_mtime"])
+             for row in connection.execute("SELECT workflow_id, source_size, source_mtime FROM workflows")}
+    ingested = 0
+    for path in sorted(Path(metadata_dir).glob("*.json")):
+        stat = path.stat()
+        if known.get(path.stem) == (stat.st_size, stat.st_mtime):
+            continue
+        logging.debug(f"Ingesting {path}")
+        with open(path) as f:
+            metadata = json.load(f)
+        metadata.setdefault("id", path.stem)
+        with connection:
+            add_workflow(connection, metadata, stat.st_size, stat.st_mtime)
+        ingested += 1
+    logging.info(f"Ingested {ingested} metadata files into {index_path}")
+    return ingested
+
+
+def call_from_row(row):
+    """Rebuild a call's metadata, with the fields used for costing, from its row."""
+    call = {key: row[column] for key, column in CALL_FIELDS if row[column] is not None}
+    for key, column in JSON_CALL_FIELDS:
+        if row[column] is not None:
+            call[key] = json.loads(row[column])
+    if row["preemptible"] is not None:
+        call["preemptible"] = bool(row["preemptible"])
+    return call
+
+
+def load_metadata(index_path, workflow_id):
+    """
+    Workflow metadata as read from a metadata file, rebuilt from the index.
+
+    Only the fields the billing scripts use are included.
+    """
+    connection = connect(index_path)
+    workflow = connection.execute("SELECT * FROM workflows WHERE workflow_id = ?",
+                                  (workflow_id,)).fetchone()
+    if workflow is None:
+        raise KeyError(f"Workflow {workflow_id} is not in index {index_path}")
+    metadata = {"id": workflow_id,
+                "workflowName": workflow["workflow_name"],
+                "status": workflow["status"],
+                "start": workflow["start_time"],
+                "end": workflow["end_time"],
+                "calls": {}}
+    if workflow["parent_workflow_id"]:
+        metadata["parentWorkflowId"] = workflow["parent_workflow_id"]
+        metadata["rootWorkflowId"] = workflow["root_workflow_id"]
+    rows = connection.execute("SELECT * FROM calls WHERE workflow_id = ? ORDER BY rowid",
+                              (workflow_id,))
+    for row in rows:
+        metadata["calls"].setdefault(row["call_name"], []).append(call_from_row(row))
+    return metadata
+
+
+def fingerprint(index_path, workflow_id):
+    """Size and mtime of the file a workflow was ingested from, as "size:mtime", or None."""
+    workflow = connect(index_path).execute(
+        "SELECT source_size, source_mtime FROM workflows WHERE workflow_id = ?", (workflow_id,)).fetchone()
+    if workflow is None or workflow["source_size"] is None:
+        return None
+    return f"{workflow['source_size']}:{workflow['source_mtime']}"
+
+
+def without_subworkflows(roots, subworkflows):
+    """Sorted roots, less any of them in subworkflows, logging those left out."""
+    dropped = sorted(set(roots) & set(subworkflows))
+    if dropped:
+        logging.warning(f"Not costing {len(dropped)} workflows without a parent that other workflows "
+                        f"run as subworkflows: {', '.join(dropped)}")
+    return sorted(set(roots) - set(dropped))
+
+
+def root_workflow_ids(index_path):
+    """IDs of every root workflow in the index, less any another workflow runs as a subworkflow."""
+    db = connect(index_path)
+    roots = [row["workflow_id"] for row in db.execute(
+        "SELECT workflow_id FROM workflows WHERE parent_workflow_id IS NULL")]
+    subworkflows = [row["subworkflow_id"] for row in db.execute(
+        "SELECT subworkflow_id FROM calls WHERE subworkflow_id IS NOT NULL")]
+    return without_subworkflows(roots, subworkflows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build or update a SQLite index of workflow metadata files, for fast repeated billing.")
+    parser.add_argument("metadata_dir", help="local directory of <workflow_id>.json metadata files")
+    parser.add_argument("index", help=f"path of the index to create or update, ending in one of {', '.join(INDEX_SUFFIXES)}")
+    args = parser.parse_args()
+
+    log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=log_level,
+        format='[%(levelname)s] %(message)s'
+    )
+
+    if not is_index(args.index):
+        parser.error(f"index path must end in one of {', '.join(INDEX_SUFFIXES)}")
+    ingest(args.metadata_dir, args.index)
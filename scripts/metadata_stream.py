@@ -0,0 +1,63 @@
+import ijson
+
+from metadata_cache import COSTING_CALL_KEYS, COSTING_WORKFLOW_KEYS
+
+
+def _is_calls(entry):
+    kind, key = entry
+    return kind == "map" and key == "calls"
+
+
+def load_costing_fields(fp):
+    """
+    Incrementally parse workflow metadata from fp, keeping only the fields needed for costing.
+
+    The same as metadata_cache.costing_fields(json.load(fp)), but
+    without ever holding the whole document. Parse events are walked
+    one at a time and only the values of wanted keys, at the top level
+    and within each call, are built into objects. Peak memory is set
+    by the result plus the largest single wanted value, rather than by
+    the size of the file.
+    """
+    metadata = {}
+    calls = metadata["calls"] = {}
+    stack = []  # (kind, key it sits under) of each open container
+    key = None
+    call = None
+    builder = None
+    target = capture_key = None
+    capture_depth = 0
+    for event, value in ijson.basic_parse(fp, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                capture_depth += 1
+            elif event in ("end_map", "end_array"):
+                capture_depth -= 1
+            if capture_depth == 0:
+                target[capture_key] = builder.value
+                builder = None
+            continue
+
+        if event == "map_key":
+            key = value
+            depth = len(stack)
+            if depth == 1 and key in COSTING_WORKFLOW_KEYS and key != "calls":
+                target = metadata
+            elif depth == 4 and _is_calls(stack[1]) and key in COSTING_CALL_KEYS:
+                target = call
+            else:
+                continue
+            builder, capture_key, capture_depth = ijson.ObjectBuilder(), key, 0
+        elif event in ("start_map", "start_array"):
+            parent_kind = stack[-1][0] if stack else None
+            stack.append(("map" if event == "start_map" else "array",
+                          key if parent_kind == "map" else None))
+            if len(stack) == 3 and _is_calls(stack[1]) and event == "start_array":
+                calls[key] = []
+            elif len(stack) == 4 and _is_calls(stack[1]) and event == "start_map":
+                call = {}
+                calls[stack[2][1]].append(call)
+        elif event in ("end_map", "end_array"):
+            stack.pop()
+    return metadata
@@ -1,43 +1,214 @@
+import base64
+import hashlib
+import io
 import json
 import logging
+import mmap
 import os
 import re
 import requests
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 CROMWELL_API = "http://localhost:8000/api"
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_RATE = 20  # requests per second
+DEFAULT_RETRIES = 5
+SPOOL_LIMIT = 64 * 2**20  # bytes of a response body kept in memory
 
 
-def _request_workflow(endpoint):
-    logging.debug(f"Requesting workflow endpoint {endpoint}")
-    return requests.get(f"{CROMWELL_API}/workflows/v1/{endpoint}")
+class RateLimiter:
+    """Space out calls to `wait` so they average at most `rate` per second, across threads."""
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
 
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(self._next, now)
+            self._next = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
 
-def _save_locally(contents, filename):
-    target = f"{LOCAL_DIR}/{filename}"
-    logging.debug(f"Writing {target}")
-    os.makedirs(Path(target).parent, exist_ok=True)
-    with open(target, 'w') as f:
-        f.write(contents)
 
+class CromwellClient:
+    """Pooled, rate-limited access to the Cromwell workflows API.
 
-def persist_artifacts(artifacts_dir):
+    One keep-alive session is shared by all threads. Connection errors
+    and 429/5xx responses are retried with exponential backoff.
     """
-    Persist artifacts to either Google Cloud Storage (if gcs_artifacts_dir starts with 'gs://')
-    or to a local directory (if it does not start with 'gs://').
+    def __init__(self, api=CROMWELL_API, workers=DEFAULT_WORKERS,
+                 max_rate=DEFAULT_MAX_RATE, retries=DEFAULT_RETRIES):
+        self.api = api
+        self.limiter = RateLimiter(max_rate)
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request_workflow(self, endpoint, **kwargs):
+        self.limiter.wait()
+        logging.debug(f"Requesting workflow endpoint {endpoint}")
+        return self.session.get(f"{self.api}/workflows/v1/{endpoint}", **kwargs)
+
+
+class SpooledBody:
+    """A response body held in memory, or in a temp file once larger than `limit` bytes.
+
+    Its size and MD5 are computed as it is read.
     """
+    def __init__(self, chunks, limit=SPOOL_LIMIT):
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self.file = io.BytesIO()
+        for chunk in chunks:
+            if isinstance(self.file, io.BytesIO) and self.size + len(chunk) > limit:
+                spilled = tempfile.NamedTemporaryFile()
+                spilled.write(self.file.getbuffer())
+                self.file = spilled
+            self.file.write(chunk)
+            self._md5.update(chunk)
+            self.size += len(chunk)
+        self.file.flush()
+
+    @property
+    def path(self):
+        """Path of the temp file holding the body, None if held in memory."""
+        return getattr(self.file, "name", None)
+
+    @property
+    def md5(self):
+        return base64.b64encode(self._md5.digest()).decode()
+
+    @contextmanager
+    def contents(self):
+        """The body as a bytes-like object, memory-mapped if it was spilled to disk."""
+        if self.path is None:
+            with self.file.getbuffer() as view:
+                yield view
+        elif self.size == 0:
+            yield b""
+        else:
+            with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                yield view
+
+    def close(self):
+        self.file.close()
+
+
+class LocalSink:
+    """Artifacts written straight into a local directory."""
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def uri(self, name):
+        return f"{self.root}/{name}"
+
+    def unchanged(self, name, body):
+        target = self.root / name
+        if not target.is_file() or target.stat().st_size != body.size:
+            return False
+        md5 = hashlib.md5()
+        with open(target, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                md5.update(chunk)
+        return base64.b64encode(md5.digest()).decode() == body.md5
+
+    def write(self, name, body):
+        """Write body to name. Returns True on success."""
+        target = self.root / name
+        try:
+            os.makedirs(target.parent, exist_ok=True)
+            body.file.seek(0)
+            with open(f"{target}.part", 'wb') as f:
+                shutil.copyfileobj(body.file, f)
+            os.replace(f"{target}.part", target)
+        except OSError as e:
+            logging.error(f"Failed to write {target}: {e}")
+            return False
+        return True
+
+
+class GCSSink:
+    """Artifacts uploaded straight into a GCS path with gsutil.
+
+    Existing objects are listed once, up front, to check for unchanged
+    contents. Bodies large enough to have spilled to disk are uploaded
+    as parallel composite uploads; those objects have no MD5, so they
+    are compared by size alone.
+    """
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+        self.existing = self._list_existing()
+
+    def _list_existing(self):
+        listing = subprocess.run(["gsutil", "ls", "-L", f"{self.root}/**"],
+                                 capture_output=True, text=True).stdout
+        existing = {}
+        for block in re.split(r"^(?=gs://)", listing, flags=re.MULTILINE):
+            uri = re.match(r"(gs://.+):\s*$", block, flags=re.MULTILINE)
+            size = re.search(r"Content-Length:\s+(\d+)", block)
+            md5 = re.search(r"Hash \(md5\):\s+(\S+)", block)
+            if uri and size:
+                existing[uri.group(1)] = (int(size.group(1)), md5 and md5.group(1))
+        return existing
+
+    def uri(self, name):
+        return f"{self.root}/{name}"
+
+    def unchanged(self, name, body):
+        size, md5 = self.existing.get(self.uri(name), (None, None))
+        return size == body.size and (md5 is None or md5 == body.md5)
+
+    def write(self, name, body):
+        """Upload body to name. Returns True on success."""
+        command = ["gsutil", "-q", "-o", f"GSUtil:parallel_composite_upload_threshold={SPOOL_LIMIT}",
+                   "cp", body.path or "-", self.uri(name)]
+        if body.path:
+            result = subprocess.run(command)
+        else:
+            body.file.seek(0)
+            result = subprocess.run(command, input=body.file.getvalue())
+        if result.returncode != 0:
+            logging.error(f"Failed to upload {self.uri(name)}")
+            return False
+        return True
+
+
+def make_sink(artifacts_dir):
+    """Sink for artifacts_dir: GCS if it starts with 'gs://', else a local directory."""
     if artifacts_dir.startswith("gs://"):
-        # Handle Google Cloud Storage
-        logging.info(f"Copying {LOCAL_DIR} to Google Cloud Storage at {artifacts_dir}")
-        os.system(f"gsutil -q cp -r -n {LOCAL_DIR} {artifacts_dir}")
+        return GCSSink(artifacts_dir)
+    else:
+        return LocalSink(artifacts_dir)
+
+
+def save(sink, name, body):
+    """Write body to name in sink, unless it's already there with the same contents.
+
+    Returns False if it had to be written and the write failed.
+    """
+    if sink.unchanged(name, body):
+        logging.debug(f"Unchanged, skipping {sink.uri(name)}")
+        return True
     else:
-        # Handle local directory
-        logging.info(f"Copying {LOCAL_DIR} to local directory at {artifacts_dir}")
-        os.makedirs(artifacts_dir, exist_ok=True)  # Ensure the target directory exists
-        os.system(f"cp -r {LOCAL_DIR}/* {artifacts_dir}")
-        
+        logging.debug(f"Writing {sink.uri(name)}")
+        return sink.write(name, body)
 
 
 def json_str(obj):
@@ -46,140 +217,149 @@ def json_str(obj):
 
 # TODO(john): save info about current VM
 
-def is_cache_hit(call):
-    if ("callCaching" in call) and not ("hit" in call["callCaching"]):
-        logging.debug(f"callCaching entry with no hit key: {call}")
-        return False
-    else:
-        return ("callCaching" in call) \
-            and ("hit" in call["callCaching"]) \
-            and call["callCaching"]["hit"]
-
-
-def cached_id(call):
-    """ Extract the ID of the cached version of `call` from `call[callCaching][result]`. """
-    # example: "Cache Hit: 7f84432e-c1e2-42d6-b3ba-c48521c2db47:immuno.extractAlleles:-1"
-    # "Cache Hit: (uuid):(workflowName):(shardIndex)"
-    result = call["callCaching"]["result"]
-    match = re.match(
-        "Cache Hit: ([-0-9a-f]+):(.+):(-1|[0-9]+)",
-        result
-    )
-    # These don't do anything to handle the error -- just let the script fail naturally
-    if not match:
-        logging.error(f"No matches to parse a subworkflow ID out of result {result}")
-    if not len(match.groups()) == 3:
-        logging.error(f"Match did not result in three groups as expected: len({match.groups()}) == {len(match.groups())}")
-    cached_call, _workflow_name, _shard_index = match.groups()
-    return cached_call
+SUBWORKFLOW_ID_PATTERN = re.compile(rb'"subWorkflowId"\s*:\s*"([^"]+)"')
+CACHE_HIT_PATTERN = re.compile(rb'"result"\s*:\s*"Cache Hit: ([-0-9a-f]+):([^"]+):(?:-1|[0-9]+)"')
 
 
-def all_calls(metadata):
-    """All of a workflow's direct calls, flattened out of the nested structure."""
-    for call_name, calls in metadata.get("calls", {}).items():
-        for idx, call in enumerate(calls):
-            yield call, call_name, idx
+def scan_referenced_workflows(contents):
+    """(workflow ID, call name) of every subworkflow and cached call that raw metadata bytes point to.
+
+    The bytes are searched for subworkflow IDs and cache hit results,
+    so the metadata tree is never built. Subworkflows are named
+    "subworkflow" since their call name isn't picked up.
+    """
+    subworkflows = [(match.group(1).decode(), "subworkflow")
+                    for match in SUBWORKFLOW_ID_PATTERN.finditer(contents)]
+    cached_calls = [(match.group(1).decode(), match.group(2).decode())
+                    for match in CACHE_HIT_PATTERN.finditer(contents)]
+    return subworkflows + cached_calls
+
+
+def crawl(workflow_id, visit, workers=DEFAULT_WORKERS):
+    """Apply visit to workflow_id and every workflow reachable from it.
+
+    visit(workflow_id, workflow_name) runs on a pool of `workers`
+    threads and returns the (workflow ID, name) pairs that workflow
+    references, which are queued as soon as they are discovered. Each
+    workflow ID is visited once.
+    """
+    seen = {workflow_id}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(visit, workflow_id, "root")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for child_id, child_name in future.result():
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        pending.add(pool.submit(visit, child_id, child_name))
+
+
+def read_outputs(body):
+    """
+    The outputs of a workflow from its spooled metadata, or None if it has none.
+    Parsed incrementally with ijson if it's installed, else with json,
+    which holds the whole document in memory.
+    """
+    body.file.seek(0)
+    try:
+        import ijson
+    except ImportError:
+        logging.warning("ijson is not installed, parsing the root workflow's whole metadata to find its outputs")
+        return json.load(body.file).get("outputs")
+    return next(ijson.items(body.file, "outputs", use_float=True), None)
 
 
-def fetch_metadata(workflow_id):
-    """Fetch metadata for workflow_id and all its subworkflows.
+def stream_metadata(client, workflow_id, sink, workers=DEFAULT_WORKERS):
+    """Fetch metadata and timing for workflow_id and all its subworkflows, straight into sink.
 
     Cromwell API allows doing this in the metadata endoint BUT it
     times out on larger workflows like Immuno, which renders it
-    basically useless to us. Crawl it ourselves. This puts everything
-    into memory. If that becomes an issue (which would be very
-    surprising to me) then it should be modified to a generator of
-    key-value pairs.
+    basically useless to us. Crawl it ourselves, concurrently. Each
+    response body is written to the sink as soon as it has been read
+    and only the referenced workflow IDs, and the root's outputs, are
+    pulled back out, so at most one spooled document per worker is held
+    in memory. Bodies are saved as served by Cromwell, not re-indented,
+    under metadata/ and timing/. The root workflow is also saved as
+    metadata.json, timing.html, and outputs.json for easy access.
+
+    Returns (IDs of every workflow whose artifacts were all saved,
+    IDs of workflows whose metadata couldn't be fetched, or with an
+    artifact that failed to save).
     """
-    metadata_by_workflow_id = {}
-    workflow_ids_frontier = [(workflow_id, "root")]
-    workflow_ids_master = [(workflow_id, "root")]
-    while workflow_ids_frontier:
-        workflow_id_count = len(workflow_ids_frontier)
-        workflow_id, workflow_name = workflow_ids_frontier.pop()
+    saved = []
+    failed = []
+    root_id = workflow_id
+
+    def fetch(endpoint):
+        with client.request_workflow(endpoint, stream=True) as response:
+            if not response.ok:
+                logging.error(f"{endpoint} endpoint returned non-OK response {response}")
+                return None
+            return SpooledBody(response.iter_content(chunk_size=2**20))
+
+    def visit(workflow_id, workflow_name):
         logging.info(f"Fetching metadata for workflow {workflow_name} {workflow_id}")
-        response = _request_workflow(f"{workflow_id}/metadata")
-        if response.ok:
-            metadata = response.json()
-            metadata_by_workflow_id[workflow_id] = metadata
-            # Follow subworkflows
-            subworkflows = [(call["subWorkflowId"], name)
-                            for call, name, _ in all_calls(metadata)
-                            if "subWorkflowId" in call]
-            # Only add new subworkflow IDs to be processed if we have not already processed them
-            new_subworkflow_ids = list(set(subworkflows) - set(workflow_ids_master))
-            workflow_ids_master.extend(new_subworkflow_ids)
-            workflow_ids_frontier.extend(new_subworkflow_ids)
-            # Follow cached calls
-            cached_calls = [(cached_id(call), name)
-                            for call, name, _ in all_calls(metadata)
-                            if is_cache_hit(call)]
-            # Only add new cached ids to be processed if we have not already processed them
-            new_cached_ids = list(set(cached_calls) - set(workflow_ids_master))
-            workflow_ids_master.extend(new_cached_ids)
-            workflow_ids_frontier.extend(new_cached_ids)
-        else:
-            logging.error(f"{workflow_id}/metadata endpoint returned non-OK response {response}")
-    return metadata_by_workflow_id
-
-
-def fetch_all_timing(metadata_by_workflow_id):
-    """ Fetch timing contents for every workflow, storing in memory. """
-    timing_by_workflow_id = {}
-    for workflow_id, metadata in metadata_by_workflow_id.items():
-        logging.info(f"Fetching timing for workflow {workflow_id}")
-        response = _request_workflow(f"{workflow_id}/timing")
-        if response.ok:
-            timing_by_workflow_id[workflow_id] = response.text
-        else:
-            logging.error(f"{workflow_id}/timing returned non-OK response {response}")
-    return timing_by_workflow_id
+        try:
+            timing = fetch(f"{workflow_id}/timing")
+        except requests.RequestException as e:
+            logging.error(f"Timing request for workflow {workflow_id} failed: {e}")
+            timing = None
+        try:
+            metadata = fetch(f"{workflow_id}/metadata")
+        except requests.RequestException as e:
+            logging.error(f"Metadata request for workflow {workflow_id} failed: {e}")
+            metadata = None
+        ok = True
+        if timing:
+            ok = save(sink, f"timing/{workflow_id}.html", timing) and ok
+            if workflow_id == root_id:
+                ok = save(sink, "timing.html", timing) and ok
+            timing.close()
+        if not metadata:
+            failed.append(workflow_id)
+            return []
+        ok = save(sink, f"metadata/{workflow_id}.json", metadata) and ok
+        with metadata.contents() as contents:
+            references = scan_referenced_workflows(contents)
+        if workflow_id == root_id:
+            ok = save(sink, "metadata.json", metadata) and ok
+            outputs = read_outputs(metadata)
+            if outputs is None:
+                logging.error(f"No outputs in metadata of workflow {workflow_id}")
+            else:
+                ok = save(sink, "outputs.json", SpooledBody([json_str({"outputs": outputs}).encode()])) and ok
+        metadata.close()
+        (saved if ok else failed).append(workflow_id)
+        return references
+
+    crawl(workflow_id, visit, workers=workers)
+    return saved, failed
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Upload Cromwell endpoint responses for a given workflow. Uploads timing, outputs, and metadata (including subworkflow metadata).")
     parser.add_argument("artifacts_dir")
     parser.add_argument("workflow_id")
+    parser.add_argument("--cromwell-api", default=CROMWELL_API,
+                        help=f"base URL of the Cromwell API. Default {CROMWELL_API}")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"number of concurrent requests to Cromwell. Default {DEFAULT_WORKERS}")
+    parser.add_argument("--max-rate", type=float, default=DEFAULT_MAX_RATE,
+                        help=f"maximum requests per second to Cromwell, 0 for no limit. Default {DEFAULT_MAX_RATE}")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"times to retry a failed request, with backoff. Default {DEFAULT_RETRIES}")
     args = parser.parse_args()
 
-    # Dynamically define LOCAL_DIR based on artifacts_dir
-    if args.artifacts_dir.startswith("gs://"):
-        LOCAL_DIR = Path(os.environ["HOME"]) / "artifacts"
-    else:
-        LOCAL_DIR = Path(os.getcwd()) / "artifacts"
-    # Ensure the directory exists
-    LOCAL_DIR.mkdir(parents=True, exist_ok=True)
-
     log_level = os.environ.get("LOGLEVEL", "INFO").upper()
     logging.basicConfig(
         level=log_level,
         format='[%(levelname)s] %(message)s'
     )
 
-    metadata_by_workflow_id = fetch_metadata(args.workflow_id) 
-    timing_by_workflow_id = fetch_all_timing(metadata_by_workflow_id)
-
-    # Save root with special names for easy access
-    root_metadata = metadata_by_workflow_id[args.workflow_id]
-    _save_locally(json_str(root_metadata), 'metadata.json')
-
-    root_timing   = timing_by_workflow_id[args.workflow_id]
-    _save_locally(root_timing,   'timing.html')
-
-    root_outputs  = {"outputs": root_metadata["outputs"]}
-    _save_locally(json_str(root_outputs),  'outputs.json')
-
-    # Save everything else in dirs. We also save the root workflow
-    # info here, duplicating it, just for ease of crawling back to
-    # root. If we want to remove that, simply uncomment the following
-    # line:
-    #
-    # del metadata_by_workflow_id[args.workflow_id]
-    #
-    for workflow_id, metadata in metadata_by_workflow_id.items():
-        _save_locally(json_str(metadata), f"metadata/{workflow_id}.json")
-    for workflow_id, timing in timing_by_workflow_id.items():
-        _save_locally(timing, f"timing/{workflow_id}.html")
-
-    # update function to handle both GCS and local directories
-    persist_artifacts(args.artifacts_dir)
+    client = CromwellClient(args.cromwell_api, workers=args.workers,
+                            max_rate=args.max_rate, retries=args.retries)
+    saved, failed = stream_metadata(client, args.workflow_id, make_sink(args.artifacts_dir), workers=args.workers)
+    if failed:
+        logging.error(f"Artifacts of {len(failed)} workflows failed to fetch or save: {', '.join(failed)}")
+        exit(1)
@@ -0,0 +1,146 @@
+import csv
+import hashlib
+import json
+import logging
+
+from bisect import bisect_right
+from collections import defaultdict
+from pathlib import Path
+
+
+ANY = "*"
+DEFAULT_REGION = "us-central1"
+
+# Resources a catalog prices, and their units
+#   cpu     per vCPU per hour
+#   memory  per GB per hour
+#   <disk>  per GB per month, for each disk type e.g. SSD, HDD
+CPU = "cpu"
+MEMORY = "memory"
+
+CSV_FIELDS = ["resource", "family", "region", "preemptible", "price", "effectiveDate"]
+
+
+def _is_true(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "yes", "1")
+
+
+class PriceCatalog:
+    """
+    Unit prices of compute resources, by machine family, region, and date.
+
+    Each entry prices one resource for one machine family and region,
+    preemptible or not, from its effectiveDate (YYYY-MM-DD) until the
+    next entry for the same key takes over. An entry without an
+    effectiveDate applies from the beginning of time. Family and region
+    can be "*" to match any not listed explicitly. Disk types are priced
+    the same way, and usually have family "*" and preemptible false.
+
+    The prices in effect on a day are resolved once, the first time
+    that day is asked for, after which each lookup is a dict access.
+    """
+    def __init__(self, entries, default_region=DEFAULT_REGION):
+        self.default_region = default_region
+        history = defaultdict(list)
+        for entry in entries:
+            key = (entry["resource"], entry.get("family") or ANY, entry.get("region") or ANY,
+                   _is_true(entry.get("preemptible", False)))
+            history[key].append((entry.get("effectiveDate") or "", float(entry["price"])))
+        self._history = {}
+        for key, prices in history.items():
+            prices.sort()
+            self._history[key] = ([date for date, _ in prices], [price for _, price in prices])
+        self._days = {}
+        self._fingerprint = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a catalog from a JSON or CSV file, by extension.
+
+        JSON files hold {"defaultRegion": ..., "prices": [entry, ...]},
+        or just the list of entries. CSV files have a header row naming
+        the columns in CSV_FIELDS, one entry per row.
+        """
+        path = Path(path)
+        if path.suffix == ".csv":
+            with open(path, newline='') as f:
+                entries = list(csv.DictReader(f))
+            catalog = cls(entries)
+        else:
+            with open(path) as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                catalog = cls(data)
+            else:
+                catalog = cls(data["prices"], data.get("defaultRegion", DEFAULT_REGION))
+        logging.info(f"Loaded prices of {len(catalog._history)} resources from {path}")
+        return catalog
+
+    def fingerprint(self):
+        """Digest of every price in the catalog, to tell whether two catalogs price the same."""
+        if self._fingerprint is None:
+            contents = json.dumps([self.default_region, sorted([list(key), dates, values]
+                                                               for key, (dates, values) in self._history.items())])
+            self._fingerprint = hashlib.sha1(contents.encode()).hexdigest()
+        return self._fingerprint
+
+    def prices_on(self, day):
+        """Every key's price in effect on day, a YYYY-MM-DD string."""
+        prices = self._days.get(day)
+        if prices is None:
+            prices = {}
+            for key, (dates, values) in self._history.items():
+                i = bisect_right(dates, day)
+                if i:
+                    prices[key] = values[i - 1]
+            self._days[day] = prices
+        return prices
+
+    def price(self, resource, family=ANY, region=None, preemptible=False, when=""):
+        """
+        Unit price of resource on the day of ISO 8601 timestamp when.
+
+        The most specific of the catalog's entries is used, an exact
+        family and region before either of them being "*". Region
+        defaults to the catalog's default region.
+        """
+        prices = self.prices_on(when[:10])
+        key = (resource, family, region or self.default_region, preemptible)
+        price = prices.get(key)
+        if price is None:
+            for family_, region_ in [(key[1], ANY), (ANY, key[2]), (ANY, ANY)]:
+                price = prices.get((resource, family_, region_, preemptible))
+                if price is not None:
+                    prices[key] = price
+                    break
+            else:
+                raise NotImplementedError(f"No price for {resource} on {'preemptible ' if preemptible else ''}{family} "
+                                          f"in {key[2]} effective {when[:10] or 'always'}")
+        return price
+
+    def machine_prices(self, family, region=None, preemptible=False, when=""):
+        """{"cpu": ..., "memory": ...} unit prices of a machine family."""
+        return {CPU: self.price(CPU, family, region, preemptible, when),
+                MEMORY: self.price(MEMORY, family, region, preemptible, when)}
+
+
+def from_prices(machine_prices, preemptible_machine_prices, disk_prices, family="n1"):
+    """
+    A catalog of one machine family's cpu and memory prices, and disk
+    prices, that apply in every region at all times. Built from dicts
+    like {"cpu": ..., "memory": ...} and {"SSD": ..., "HDD": ...}.
+    """
+    entries = []
+    for preemptible, prices in [(False, machine_prices), (True, preemptible_machine_prices)]:
+        entries += [{"resource": resource, "family": family, "preemptible": preemptible, "price": price}
+                    for resource, price in prices.items()]
+    entries += [{"resource": disk_type, "price": price} for disk_type, price in disk_prices.items()]
+    return PriceCatalog(entries)
+
+
+def region_of(zone):
+    """Region of a zone, e.g. us-central1 for us-central1-c"""
+    return zone.rsplit('-', 1)[0] if zone else None
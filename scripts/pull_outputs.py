@@ -1,14 +1,21 @@
 # built-in
+import base64
+import hashlib
 import json
 import logging
 import os
 import subprocess
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
 from pathlib import Path
 
 
 DEFAULT_OUTPUTS_DIR = './outputs'
 DEFAULT_DRYRUN = False
+DEFAULT_JOBS = 8
+COMPRESSION_SUFFIXES = {"gz", "bgz", "bz2", "zip"}
 
 DRYRUN = DEFAULT_DRYRUN
 
@@ -18,6 +25,7 @@ def download_file(src, dest):
     Copy a file from `src` to `dest`. 
     - If `src` starts with "gs://", it uses `gsutil` to copy the file from Google Cloud Storage.
     - If `src` is a local path, it uses the `cp` command to copy the file locally.
+    Returns True if the copy succeeded.
     """
     os.makedirs(Path(dest).parent, exist_ok=True)  # Ensure the destination directory exists
     if not Path(dest).is_file():  # Check if the file already exists
@@ -25,42 +33,246 @@ def download_file(src, dest):
         if not DRYRUN:
             if src.startswith("gs://"):
                 # Use gsutil for Google Cloud Storage paths
-                subprocess.call(['gsutil', '-q', 'cp', '-n', src, dest])
+                return subprocess.call(['gsutil', '-q', 'cp', '-n', src, dest]) == 0
             else:
                 # Use cp for local paths
-                subprocess.call(['cp', src, dest])
+                return subprocess.call(['cp', src, dest]) == 0
     else:
         logging.info(f"File already exists, skipping copy {src} to {dest}")
+    return True
 
 
-def download(path, value, subdir=None):
+def file_type(src):
+    """Type of a file by its extension, e.g. bam, or vcf.gz for compressed files."""
+    suffixes = [suffix.lstrip(".") for suffix in Path(src).suffixes]
+    if len(suffixes) > 1 and suffixes[-1] in COMPRESSION_SUFFIXES:
+        return ".".join(suffixes[-2:])
+    return suffixes[-1] if suffixes else ""
+
+
+def collect_files(path, value, subdir=None, files=None, output=None):
     """
-    Recursively download all output files.
-    - If `value` is a GCS file (starts with "gs://"), it will be downloaded using `download_file`.
-    - If `value` is a local file, it will also be handled by `download_file`.
+    Recursively collect a manifest entry for every file of an output, without downloading anything.
+    - A string `value` is a file, GCS or local, placed in `path` under its own name.
     - `subdir` is an optional value _only_ for types which need a directory, e.g., lists and dicts.
-    If `subdir` is specified, list/dict types will download under `path/subdir`.
+    If `subdir` is specified, list/dict types are placed under `path/subdir`.
+    - `output` is the name of the output the files belong to, defaulting to `subdir`.
     """
+    files = [] if files is None else files
+    output = output or subdir
     if isinstance(value, list):
         for loc in value:
-            download(f"{Path(path)}/{subdir or ''}", loc)
+            collect_files(f"{Path(path)}/{subdir or ''}", loc, files=files, output=output)
     elif isinstance(value, dict):
         for k, v in value.items():
-            download(f"{path}/{subdir or ''}", v, subdir=k)
+            collect_files(f"{path}/{subdir or ''}", v, subdir=k, files=files, output=output)
     elif isinstance(value, str):
-        # Handle both GCS and local paths
-        download_file(value, Path(f"{path}/{Path(value).name}"))
+        files.append({"output": output, "src": value,
+                      "dest": str(Path(f"{path}/{Path(value).name}")), "type": file_type(value)})
     elif value is None:
         logging.info(f"Skipping optional output that wasn't defined{': ' + subdir if subdir else ''}")
     else:
         logging.error(f"Don't know how to download type {type(value)}. Full object: {value}")
+    return files
 
 
-def download_outputs(response, outputs_dir):
-    "Download outputs, using their output_name and file extension, not path structure."
+def build_manifest(response, outputs_dir):
+    """
+    Flat list of every output file as {"output", "src", "dest", "type"},
+    using their output_name and file extension, not path structure.
+    """
+    manifest = []
     for k, v in response['outputs'].items():
         output_name = k.split(".")[-1]
-        download(outputs_dir, v, subdir=output_name)
+        collect_files(outputs_dir, v, subdir=output_name, files=manifest)
+    return manifest
+
+
+def matches(entry, patterns):
+    """Whether a manifest entry's output name, file name, or type matches any of the glob patterns."""
+    return any(fnmatch(entry["output"], pattern) or fnmatch(Path(entry["src"]).name, pattern)
+               or fnmatch(entry["type"], pattern) for pattern in patterns)
+
+
+def select(manifest, only=None, exclude=None):
+    """Entries of manifest matching any of the `only` patterns, if given, and none of `exclude`."""
+    return [entry for entry in manifest
+            if (not only or matches(entry, only)) and not (exclude and matches(entry, exclude))]
+
+
+def write_manifest(manifest, path):
+    """Write a manifest as JSON, to a file or "-" for stdout."""
+    if path == "-":
+        print(json.dumps(manifest, indent=4))
+    else:
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        logging.info(f"Manifest of {len(manifest)} files written to {path}")
+
+
+def file_md5(path, chunk_size=2**20):
+    """Streaming MD5 of a file's contents, base64 encoded as GCS reports it."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode()
+
+
+def source_stat(src):
+    """
+    (size, md5) of a GCS object or local file, or None if it can't be found.
+    md5 is None for local files, and for objects GCS has no MD5 for,
+    e.g. composite uploads, which can then only be checked by size.
+    """
+    if not src.startswith("gs://"):
+        return (os.path.getsize(src), None) if os.path.isfile(src) else None
+    result = subprocess.run(['gsutil', '-q', 'stat', src], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    fields = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.strip().partition(":")
+        fields[key] = value.strip()
+    if "Content-Length" not in fields:
+        return None
+    return int(fields["Content-Length"]), fields.get("Hash (md5)")
+
+
+def list_sizes(prefix):
+    """Size of every GCS object directly under prefix, by URI, from one listing."""
+    result = subprocess.run(['gsutil', 'ls', '-l', f"{prefix}/"], capture_output=True, text=True)
+    sizes = {}
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0].isdigit():
+            sizes[fields[2]] = int(fields[0])
+    return sizes
+
+
+def source_size(src, sizes):
+    """Size of src, from sizes if it was listed there, else looked up. None if it can't be found."""
+    if src in sizes:
+        return sizes[src]
+    stat = source_stat(src)
+    return stat and stat[0]
+
+
+class DownloadResult:
+    def __init__(self, src, dest, status, size, seconds):
+        self.src = src
+        self.dest = dest
+        self.status = status
+        self.size = size
+        self.seconds = seconds
+
+    def __repr__(self):
+        return f"DownloadResult(src=\"{self.src}\", status=\"{self.status}\")"
+
+
+def download_one(src, dest, sizes=None):
+    """
+    Download a single file and check it arrived intact. Returns a DownloadResult
+    with status one of "downloaded", "skipped", "failed", or "dryrun".
+
+    A file already at dest is only skipped if it's the same size as src,
+    taken from sizes if src was listed there; otherwise it's downloaded
+    again. With DRYRUN nothing is looked up, and files already at dest
+    are skipped. After downloading, the file's size, and MD5 where GCS
+    has one, must match src or it's deleted.
+    """
+    start = time.monotonic()
+    sizes = sizes or {}
+    if dest.is_file():
+        if DRYRUN:
+            return DownloadResult(src, dest, "skipped", dest.stat().st_size, 0.0)
+        size = source_size(src, sizes)
+        if size is None:
+            logging.error(f"Could not find {src}")
+            return DownloadResult(src, dest, "failed", 0, 0.0)
+        if dest.stat().st_size == size:
+            return DownloadResult(src, dest, "skipped", size, 0.0)
+        logging.warning(f"{dest} is {dest.stat().st_size} bytes, not {size}; downloading it again")
+        dest.unlink()
+    if DRYRUN:
+        return DownloadResult(src, dest, "dryrun", 0, 0.0)
+    if not download_file(src, dest):
+        logging.error(f"Failed to download {src}")
+        return DownloadResult(src, dest, "failed", 0, time.monotonic() - start)
+    size, md5 = source_stat(src) or (None, None)
+    if dest.stat().st_size != size or (md5 and file_md5(dest) != md5):
+        logging.error(f"Downloaded {dest} doesn't match {src}, removing it")
+        dest.unlink()
+        status = "failed"
+    else:
+        status = "downloaded"
+    return DownloadResult(src, dest, status, size or 0, time.monotonic() - start)
+
+
+def conflicting_dests(files):
+    """Map of each dest that more than one distinct src of files would download to, to those srcs."""
+    sources = {}
+    for src, dest in dict.fromkeys(files):
+        sources.setdefault(dest, []).append(src)
+    return {dest: srcs for dest, srcs in sources.items() if len(srcs) > 1}
+
+
+def download_all(files, jobs=DEFAULT_JOBS):
+    """
+    Download every (src, dest) of files using a pool of `jobs` workers,
+    logging progress as each finishes. Returns the DownloadResult of every file.
+
+    Repeated (src, dest) pairs are downloaded once. Files whose dest is
+    shared with a different src aren't downloaded at all, and fail,
+    rather than racing to write the same path. The sizes of GCS objects
+    with a file already at their dest are listed once per directory,
+    rather than looked up one at a time.
+    """
+    done_bytes = 0
+    results = []
+    conflicts = conflicting_dests(files)
+    for dest, srcs in conflicts.items():
+        logging.error(f"{', '.join(srcs)} all download to {dest}, skipping them")
+        results.extend(DownloadResult(src, dest, "failed", 0, 0.0) for src in srcs)
+    files = [(src, dest) for src, dest in dict.fromkeys(files) if dest not in conflicts]
+    total = len(files) + len(results)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        sizes = {}
+        if not DRYRUN:
+            prefixes = {src.rsplit("/", 1)[0] for src, dest in files
+                        if src.startswith("gs://") and dest.is_file()}
+            for listed in pool.map(list_sizes, prefixes):
+                sizes.update(listed)
+        futures = [pool.submit(download_one, src, dest, sizes) for src, dest in files]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result.status == "downloaded":
+                done_bytes += result.size
+            logging.info(f"[{len(results)}/{total}] {result.status} {result.dest}"
+                         f" ({result.size / 2**20:.1f} MiB)")
+    elapsed = time.monotonic() - start
+    counts = {status: sum(r.status == status for r in results)
+              for status in ["downloaded", "skipped", "failed", "dryrun"]}
+    logging.info(f"Downloaded {counts['downloaded']} files, {done_bytes / 2**20:.1f} MiB in {elapsed:.1f}s "
+                 f"({done_bytes / 2**20 / max(elapsed, 1e-6):.1f} MiB/s with {jobs} workers); "
+                 f"{counts['skipped']} already present, {counts['failed']} failed")
+    return results
+
+
+def download_manifest(manifest, jobs=DEFAULT_JOBS):
+    """Download every entry of a manifest. Returns the DownloadResult of every file."""
+    return download_all([(entry["src"], Path(entry["dest"])) for entry in manifest], jobs=jobs)
+
+
+def download_outputs(response, outputs_dir, jobs=DEFAULT_JOBS, only=None, exclude=None):
+    """
+    Download outputs, using their output_name and file extension, not path structure.
+    Only files matching `only` and not `exclude` are downloaded, see select.
+    Returns the DownloadResult of every file.
+    """
+    return download_manifest(select(build_manifest(response, outputs_dir), only, exclude), jobs=jobs)
 
 
 def read_json(filename):
@@ -81,15 +293,30 @@ def read_json(filename):
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Download Cromwell outputs for a given workflow.")
-    parser.add_argument("--outputs-file",
-                        required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--outputs-file",
                         help="JSON file of workflow outputs to pull. Exclusive with workflow_id.")
+    source.add_argument("--manifest",
+                        help="manifest of files to pull, as written by --write-manifest, instead of an outputs file. "
+                        "Files go to the destinations it names, ignoring --outputs-dir.")
     parser.add_argument("--outputs-dir",
                         default=DEFAULT_OUTPUTS_DIR,
                         help=f"directory path to download outputs to.")
     parser.add_argument("--dryrun",
                         action="store_true",
                         help=f"Skips the actual download and just prints progress info. Useful for troubleshooting the script.")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS,
+                        help=f"files to download concurrently. Default {DEFAULT_JOBS}")
+    parser.add_argument("--only", action="append",
+                        help="only pull files whose output name, file name, or type matches this glob, e.g. "
+                        "'*pvacseq*' or 'tsv'. Can be given more than once.")
+    parser.add_argument("--exclude", action="append",
+                        help="skip files whose output name, file name, or type matches this glob. "
+                        "Can be given more than once.")
+    parser.add_argument("--write-manifest",
+                        help="write the manifest of selected files to this path, or - for stdout")
+    parser.add_argument("--list", action="store_true",
+                        help="print the manifest of selected files and exit without downloading")
     args = parser.parse_args()
 
     DRYRUN = args.dryrun
@@ -101,4 +328,20 @@ if __name__ == "__main__":
         format='[%(levelname)s] %(message)s'
     )
 
-    download_outputs(read_json(args.outputs_file), outputs_dir)
+    if args.manifest:
+        manifest = read_json(args.manifest)
+    else:
+        manifest = build_manifest(read_json(args.outputs_file), outputs_dir)
+    manifest = select(manifest, args.only, args.exclude)
+    if args.write_manifest:
+        write_manifest(manifest, args.write_manifest)
+    if args.list:
+        if args.write_manifest != "-":
+            write_manifest(manifest, "-")
+        exit(0)
+
+    results = download_manifest(manifest, jobs=args.jobs)
+    if any(result.status == "failed" for result in results):
+        logging.error("Some downloads failed. Rerun the same command to retry them; "
+                      "completed downloads will be skipped.")
+        exit(1)
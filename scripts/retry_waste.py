@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import sys
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from pathlib import Path
+
+from batch_billing import BACKENDS, DEFAULT_BACKEND, root_workflow_ids
+from billing import from_iso
+from costs_json_to_csv import write_csv
+from rightsize import PREEMPTION_FIELDS, preemption_waste, task_runs
+
+
+REPORT_FIELDS = ["task", "calls", "retriedCalls", "attempts", "preemptedAttempts", "failedAttempts",
+                 "totalCost", "successfulCost", "failedCost", "wasteShare",
+                 "wallClockSeconds", "retrySeconds", "retryTimeShare", *PREEMPTION_FIELDS,
+                 "preemptible", "preemptibleSavings", "preemptibleWorthIt"]
+
+
+def call_waste(attempts):
+    """
+    What a call's attempts cost and how long they took, split between
+    the attempt that succeeded and those that didn't.
+
+    Wall-clock time runs from the first attempt's start to the last
+    one's end. Retry time is the part of it before the last attempt
+    started, which the call would have saved by succeeding first time.
+    """
+    attempts = sorted(attempts, key=lambda run: run["attempt"])
+    first, last = attempts[0], attempts[-1]
+    return {
+        "attempts": len(attempts),
+        "preemptedAttempts": sum(run["preempted"] for run in attempts),
+        "failedAttempts": sum(not run["succeeded"] and not run["preempted"] for run in attempts),
+        "successfulCost": sum(run["cost"] for run in attempts if run["succeeded"]),
+        "failedCost": sum(run["cost"] for run in attempts if not run["succeeded"] and not run["preempted"]),
+        "wallClockSeconds": (from_iso(last["end"]) - from_iso(first["start"])).total_seconds(),
+        "retrySeconds": (from_iso(last["start"]) - from_iso(first["start"])).total_seconds(),
+    }
+
+
+def task_waste(billing, task, runs):
+    """
+    Retry waste of every call of a task, summed, and whether running it
+    on preemptible machines saved more than preemption cost.
+
+    Preemption waste is as rightsize.py reports it, see
+    rightsize.preemption_waste, with nonPreemptibleCost taken to need no
+    retries. preemptibleSavings is that less everything the task actually cost,
+    so negative when preemptible machines cost more than they saved.
+    """
+    attempts_by_call = defaultdict(list)
+    for run in runs:
+        attempts_by_call[(run["workflowId"], run["shardIndex"])].append(run)
+    calls = [call_waste(attempts) for attempts in attempts_by_call.values()]
+    row = {"task": task, "calls": len(calls),
+           "retriedCalls": sum(call["attempts"] > 1 for call in calls)}
+    for field in ["attempts", "preemptedAttempts", "failedAttempts", "successfulCost",
+                  "failedCost", "wallClockSeconds", "retrySeconds"]:
+        row[field] = sum(call[field] for call in calls)
+    row.update(preemption_waste(billing, runs))
+    row["totalCost"] = row["successfulCost"] + row["preemptionWasteCost"] + row["failedCost"]
+    row["wasteShare"] = (row["preemptionWasteCost"] + row["failedCost"]) / row["totalCost"] if row["totalCost"] else 0.0
+    row["retryTimeShare"] = row["retrySeconds"] / row["wallClockSeconds"] if row["wallClockSeconds"] else 0.0
+
+    row["preemptible"] = any(run["preemptible"] for run in runs)
+    if row["preemptible"]:
+        row["preemptibleSavings"] = row["nonPreemptibleCost"] - row["totalCost"]
+        row["preemptibleWorthIt"] = row["preemptibleSavings"] > 0
+    else:
+        row["preemptibleSavings"] = None
+        row["preemptibleWorthIt"] = None
+    return {field: row[field] for field in REPORT_FIELDS}
+
+
+def retry_waste(billing, location, workflow_ids):
+    """task_waste for every task in workflow_ids, most wasted cost first."""
+    runs_by_task = defaultdict(list)
+    for workflow_id in workflow_ids:
+        try:
+            for run in task_runs(billing, location, workflow_id):
+                runs_by_task[run["task"]].append(run)
+        except Exception as e:
+            logging.error(f"Could not read runs of workflow {workflow_id}: {e!r}")
+    report = [task_waste(billing, task, runs) for task, runs in runs_by_task.items()]
+    report.sort(key=lambda row: (row["preemptionWasteCost"] + row["failedCost"], row["retrySeconds"]), reverse=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Report the money and time each task lost to failed and preempted attempts, from the metadata of many runs.")
+    parser.add_argument("metadata_dir",
+                        help="directory of <workflow_id>.json metadata files, local or gs://, or a metadata index")
+    parser.add_argument("workflow_ids", nargs="*",
+                        help="root workflows to report on. Defaults to every root workflow in a local metadata_dir.")
+    parser.add_argument("--workflow-ids-file",
+                        help="file of root workflow IDs, one per line")
+    parser.add_argument("--backend", choices=BACKENDS.keys(), default=DEFAULT_BACKEND,
+                        help=f"Cromwell backend the metadata came from. Default {DEFAULT_BACKEND}")
+    parser.add_argument("--csv", action="store_true", default=False)
+    args = parser.parse_args()
+
+    log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=log_level,
+        format='[%(levelname)s] %(message)s'
+    )
+
+    location = args.metadata_dir.rstrip('/')
+    workflow_ids = list(args.workflow_ids)
+    if args.workflow_ids_file:
+        workflow_ids += [line.strip() for line in Path(args.workflow_ids_file).read_text().splitlines()
+                         if line.strip()]
+    if not workflow_ids:
+        if location.startswith("gs://"):
+            parser.error("workflow IDs must be given for a gs:// metadata_dir")
+        workflow_ids = root_workflow_ids(location)
+
+    report = retry_waste(BACKENDS[args.backend], location, workflow_ids)
+    if args.csv:
+        write_csv(sys.stdout, report, fieldnames=REPORT_FIELDS)
+    else:
+        print(json.dumps(report, indent=4))
@@ -0,0 +1,282 @@
+import csv
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from batch_billing import BACKENDS, DEFAULT_BACKEND, root_workflow_ids
+from billing import SUBWORKFLOW, SUBWORKFLOW_KEY, call_key, from_iso, parse_disks
+from costs_json_to_csv import write_csv
+
+
+DEFAULT_HEADROOM = 1.2
+DEFAULT_MIN_RUNS = 3
+DEFAULT_PREEMPTION_THRESHOLD = 0.25
+# A task whose runs on more vCPUs are no more than this much faster is not using them
+CPU_SCALING_TOLERANCE = 0.9
+MIN_DISK_GB = 10
+
+# Peak columns of the monitoring log written by monitor.sh
+MEMORY_PEAK_COLUMN = "Memory_GB_Peak"
+DISK_PEAK_COLUMN = "Disk_Percent_Peak"
+CPU_PEAK_COLUMN = "CPU_Usage_Percent_Peak"
+
+# Fields of preemption_waste, reported by both rightsize.py and retry_waste.py
+PREEMPTION_FIELDS = ["preemptionWasteCost", "preemptionWasteSeconds", "nonPreemptibleCost"]
+
+REPORT_FIELDS = ["task", "runs", "attempts", "preemptedAttempts", "totalCost", "meanSeconds",
+                 "vcpus", "memoryGb", "diskGb", "recommendedVcpus", "recommendedMemoryGb",
+                 "recommendedDiskGb", "flags", "estimatedSavings", *PREEMPTION_FIELDS]
+
+
+def task_runs(billing, location, workflow_id):
+    """
+    Every task attempt that ran in a workflow and its subworkflows,
+    with its resources, run time, and cost, including failed attempts
+    the backend doesn't cost, see billing.Backend.ran_task. Cache hits
+    are left out, since they used no resources of their own.
+    """
+    metadata = billing.metadata_cache.get(location, workflow_id)
+    for call_name, calls in metadata.get("calls", {}).items():
+        for call in calls:
+            kind = billing.backend.call_kind(call)
+            if kind == SUBWORKFLOW:
+                yield from task_runs(billing, location, call[SUBWORKFLOW_KEY])
+            elif billing.backend.ran_task(call):
+                family, vcpus, memory_gb = billing.backend.machine_shape(call)
+                disk_gb, disk_type = parse_disks(call["runtimeAttributes"]["disks"])
+                start_time, end_time = billing.backend.machine_duration(call)
+                yield {
+                    "task": call_name,
+                    "call": call_key(call_name, call),
+                    "workflowId": workflow_id,
+                    "shardIndex": call["shardIndex"],
+                    "attempt": call.get("attempt", 1),
+                    "start": call["start"],
+                    "end": call["end"],
+                    "seconds": (from_iso(end_time) - from_iso(start_time)).total_seconds(),
+                    "cost": billing.cost_task(call)["totalCost"],
+                    "family": family,
+                    "vcpus": vcpus,
+                    "memoryGb": memory_gb,
+                    "diskGb": disk_gb,
+                    "diskType": disk_type,
+                    "region": billing.backend.region(call),
+                    "preemptible": call["preemptible"],
+                    "preempted": call["backendStatus"] == "Preempted",
+                    "succeeded": call["executionStatus"] == "Done",
+                    "monitoringLog": call.get("monitoringLog")
+                }
+
+
+def read_monitoring_log(path):
+    """
+    Peak memory in GB, disk use as a fraction, and CPU use as a fraction
+    of all vCPUs, from a monitor.sh log at a local or gs:// path.
+    None for any peak the log doesn't have.
+    """
+    try:
+        if path.startswith("gs://"):
+            text = subprocess.run(['gsutil', '-q', 'cat', path], check=True,
+                                  capture_output=True, text=True).stdout
+        else:
+            text = Path(path).read_text()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Could not read monitoring log {path}: {e}")
+        return None
+    rows = list(csv.DictReader(text.splitlines(), delimiter="\t"))
+    if not rows:
+        return None
+    last = rows[-1]
+
+    def peak(column, scale=1):
+        try:
+            return float(last[column]) * scale
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    return {"memoryGb": peak(MEMORY_PEAK_COLUMN),
+            "disk": peak(DISK_PEAK_COLUMN, 1 / 100),
+            "cpu": peak(CPU_PEAK_COLUMN, 1 / 100)}
+
+
+def add_usage(runs, workers):
+    """Add the peak usage from each run's monitoring log to it, reading logs on workers threads."""
+    logged = [run for run in runs if run["monitoringLog"] and not run["preempted"]]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for run, usage in zip(logged, pool.map(read_monitoring_log, [run["monitoringLog"] for run in logged])):
+            run["usage"] = usage
+
+
+def cheapest_cpus(runs, min_runs):
+    """
+    The fewest vCPUs the task ran on that were about as fast as any
+    larger machine it ran on, or None if there's too little history.
+    """
+    seconds_by_vcpus = defaultdict(list)
+    for run in runs:
+        seconds_by_vcpus[run["vcpus"]].append(run["seconds"])
+    means = {vcpus: sum(seconds) / len(seconds) for vcpus, seconds in seconds_by_vcpus.items()
+             if len(seconds) >= min_runs}
+    if len(means) < 2:
+        return None
+    fastest = min(means.values())
+    return min(vcpus for vcpus, mean in means.items() if fastest >= CPU_SCALING_TOLERANCE * mean)
+
+
+def preemption_waste(billing, runs):
+    """
+    What a task's preempted attempts cost and how long they ran, and
+    what its successful attempts would have cost on non-preemptible machines.
+    """
+    preempted = [run for run in runs if run["preempted"]]
+    return {
+        "preemptionWasteCost": sum(run["cost"] for run in preempted),
+        "preemptionWasteSeconds": sum(run["seconds"] for run in preempted),
+        "nonPreemptibleCost": sum(sum(billing.resource_cost(
+            run["seconds"], run["family"], run["vcpus"], run["memoryGb"], run["diskGb"],
+            run["diskType"], False, run["region"], run["start"])) for run in runs if run["succeeded"])
+    }
+
+
+def recommend(billing, task, runs, headroom=DEFAULT_HEADROOM, min_runs=DEFAULT_MIN_RUNS,
+              preemption_threshold=DEFAULT_PREEMPTION_THRESHOLD):
+    """
+    Summary of a task's runs, with the machine it should ask for instead and what that would save.
+
+    vCPUs are sized from monitored peak use if there is any, otherwise
+    from runs on different vCPU counts that took as long. Memory and disk
+    are only sized from monitored peak use. Each peak is given headroom.
+    Only successful runs are sized from, and savings assume they would
+    take as long on the recommended machine. Tasks losing more than preemption_threshold of their cost to
+    preempted attempts are flagged, with what they'd have cost on
+    non-preemptible machines, and the run time lost.
+    """
+    succeeded = [run for run in runs if run["succeeded"]]
+    shape = Counter((run["vcpus"], run["memoryGb"], run["diskGb"]) for run in succeeded or runs)
+    vcpus, memory_gb, disk_gb = shape.most_common(1)[0][0]
+    recommended = {"vcpus": vcpus, "memoryGb": memory_gb, "diskGb": disk_gb}
+    flags = []
+
+    monitored = [run for run in succeeded if run.get("usage")]
+    cpu_peaks = [run["usage"]["cpu"] * run["vcpus"] for run in monitored
+                 if run["usage"]["cpu"] is not None]
+    memory_peaks = [run["usage"]["memoryGb"] for run in monitored
+                    if run["usage"]["memoryGb"] is not None]
+    disk_peaks = [run["usage"]["disk"] * run["diskGb"] for run in monitored
+                  if run["usage"]["disk"] is not None]
+    if len(cpu_peaks) >= min_runs:
+        recommended["vcpus"] = min(vcpus, max(1, math.ceil(max(cpu_peaks) * headroom)))
+    elif (fewest := cheapest_cpus(succeeded, min_runs)) is not None:
+        recommended["vcpus"] = min(vcpus, fewest)
+    if len(memory_peaks) >= min_runs:
+        recommended["memoryGb"] = min(memory_gb, math.ceil(max(memory_peaks) * headroom * 4) / 4)
+    if len(disk_peaks) >= min_runs:
+        recommended["diskGb"] = min(disk_gb, max(MIN_DISK_GB, math.ceil(max(disk_peaks) * headroom)))
+    for flag, requested, resource in [("cpu", vcpus, "vcpus"), ("memory", memory_gb, "memoryGb"),
+                                      ("disk", disk_gb, "diskGb")]:
+        if recommended[resource] < requested:
+            flags.append(f"{flag}-overprovisioned")
+
+    savings = 0.0
+    for run in succeeded:
+        if (run["vcpus"], run["memoryGb"], run["diskGb"]) != (vcpus, memory_gb, disk_gb):
+            continue
+        savings += run["cost"] - sum(billing.resource_cost(
+            run["seconds"], run["family"], recommended["vcpus"], recommended["memoryGb"],
+            recommended["diskGb"], run["diskType"], run["preemptible"], run["region"], run["start"]))
+
+    total_cost = sum(run["cost"] for run in runs)
+    waste = preemption_waste(billing, runs)
+    if total_cost and waste["preemptionWasteCost"] / total_cost > preemption_threshold:
+        flags.append("preemption-retries")
+
+    return {
+        "task": task,
+        "runs": len(succeeded),
+        "attempts": len(runs),
+        "preemptedAttempts": sum(run["preempted"] for run in runs),
+        "totalCost": total_cost,
+        "meanSeconds": sum(run["seconds"] for run in succeeded) / len(succeeded) if succeeded else None,
+        "vcpus": vcpus,
+        "memoryGb": memory_gb,
+        "diskGb": disk_gb,
+        "recommendedVcpus": recommended["vcpus"],
+        "recommendedMemoryGb": recommended["memoryGb"],
+        "recommendedDiskGb": recommended["diskGb"],
+        "flags": flags,
+        "estimatedSavings": savings,
+        **waste
+    }
+
+
+def rightsize(billing, location, workflow_ids, monitoring=False, workers=8, **options):
+    """recommend for every task in workflow_ids, most savings first."""
+    runs_by_task = defaultdict(list)
+    for workflow_id in workflow_ids:
+        try:
+            for run in task_runs(billing, location, workflow_id):
+                runs_by_task[run["task"]].append(run)
+        except Exception as e:
+            logging.error(f"Could not read runs of workflow {workflow_id}: {e!r}")
+    if monitoring:
+        add_usage([run for runs in runs_by_task.values() for run in runs], workers)
+    report = [recommend(billing, task, runs, **options) for task, runs in runs_by_task.items()]
+    report.sort(key=lambda row: (row["estimatedSavings"], row["preemptionWasteCost"]), reverse=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Recommend smaller machines for tasks that consistently don't use what they ask for, from the metadata of many runs.")
+    parser.add_argument("metadata_dir",
+                        help="directory of <workflow_id>.json metadata files, local or gs://, or a metadata index")
+    parser.add_argument("workflow_ids", nargs="*",
+                        help="root workflows to learn from. Defaults to every root workflow in a local metadata_dir.")
+    parser.add_argument("--workflow-ids-file",
+                        help="file of root workflow IDs, one per line")
+    parser.add_argument("--backend", choices=BACKENDS.keys(), default=DEFAULT_BACKEND,
+                        help=f"Cromwell backend the metadata came from. Default {DEFAULT_BACKEND}")
+    parser.add_argument("--monitoring", action="store_true", default=False,
+                        help="size tasks from the peak use in the monitor.sh logs of their runs")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="monitoring logs to read at once. Default 8")
+    parser.add_argument("--headroom", type=float, default=DEFAULT_HEADROOM,
+                        help=f"multiple of peak use to recommend. Default {DEFAULT_HEADROOM}")
+    parser.add_argument("--min-runs", type=int, default=DEFAULT_MIN_RUNS,
+                        help=f"fewest runs to base a recommendation on. Default {DEFAULT_MIN_RUNS}")
+    parser.add_argument("--preemption-threshold", type=float, default=DEFAULT_PREEMPTION_THRESHOLD,
+                        help=f"flag tasks losing more than this fraction of their cost to preemption. Default {DEFAULT_PREEMPTION_THRESHOLD}")
+    parser.add_argument("--csv", action="store_true", default=False)
+    args = parser.parse_args()
+
+    log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=log_level,
+        format='[%(levelname)s] %(message)s'
+    )
+
+    location = args.metadata_dir.rstrip('/')
+    workflow_ids = list(args.workflow_ids)
+    if args.workflow_ids_file:
+        workflow_ids += [line.strip() for line in Path(args.workflow_ids_file).read_text().splitlines()
+                         if line.strip()]
+    if not workflow_ids:
+        if location.startswith("gs://"):
+            parser.error("workflow IDs must be given for a gs:// metadata_dir")
+        workflow_ids = root_workflow_ids(location)
+
+    report = rightsize(BACKENDS[args.backend], location, workflow_ids,
+                       monitoring=args.monitoring, workers=args.workers, headroom=args.headroom,
+                       min_runs=args.min_runs, preemption_threshold=args.preemption_threshold)
+    if args.csv:
+        write_csv(sys.stdout, ({**row, "flags": " ".join(row["flags"])} for row in report),
+                  fieldnames=REPORT_FIELDS)
+    else:
+        print(json.dumps(report, indent=4))
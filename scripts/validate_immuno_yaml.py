@@ -1,76 +1,175 @@
 #!/usr/bin/env python3
 
+import json
 import os
+import sys
 import yaml
 import subprocess
 import argparse
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
 
 def is_gs_path(path):
     return path.startswith("gs://")
 
-def file_exists(path):
-    if is_gs_path(path):
-        try:
-            subprocess.check_call(["gsutil", "-q", "stat", path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            return True
-        except subprocess.CalledProcessError:
-            return False
-    elif path.startswith("/"):
-        return os.path.exists(path)
-    return False
+def split_prefix(path):
+    """gs://bucket/dir/name -> (gs://bucket/dir/, name)"""
+    prefix, _, name = path.rpartition("/")
+    return prefix + "/", name
+
+class GsutilStore:
+    """Lists GCS prefixes with gsutil, one process per prefix rather than per object."""
+    def list_prefix(self, prefix):
+        result = subprocess.run(["gsutil", "ls", prefix], capture_output=True, text=True)
+        if result.returncode != 0:  # also when nothing matches the prefix
+            if "matched no objects" not in result.stderr:
+                print(f"Warning: could not list {prefix}, taking its files to be missing: "
+                      f"{result.stderr.strip()}", file=sys.stderr)
+            return set()
+        return {line.strip() for line in result.stdout.splitlines() if line.strip()}
+
+class LocalDirStore:
+    """Stand-in for GCS backed by a local directory, where gs://bucket/key is root/bucket/key."""
+    def __init__(self, root):
+        self.root = root
+
+    def list_prefix(self, prefix):
+        directory = os.path.join(self.root, prefix[len("gs://"):])
+        if not os.path.isdir(directory):
+            return set()
+        return {prefix + name + ("/" if os.path.isdir(os.path.join(directory, name)) else "")
+                for name in os.listdir(directory)}
+
+def file_exists(path, store=None):
+    return files_exist([path], store)[path]
+
+def files_exist(paths, store=None, workers=DEFAULT_WORKERS):
+    """
+    {path: whether it exists} for every distinct path. gs:// paths are
+    checked with one listing per prefix, local paths with os.path.exists,
+    both on a pool of workers threads.
+    """
+    store = store or GsutilStore()
+    unique = list(dict.fromkeys(paths))
+    gs_paths = [p for p in unique if is_gs_path(p)]
+    local_paths = [p for p in unique if p.startswith("/")]
+    prefixes = list(dict.fromkeys(split_prefix(p)[0] for p in gs_paths))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        listings = dict(zip(prefixes, pool.map(store.list_prefix, prefixes)))
+        exists = dict(zip(local_paths, pool.map(os.path.exists, local_paths)))
+    for p in gs_paths:
+        exists[p] = p in listings[split_prefix(p)[0]]
+    for p in unique:
+        exists.setdefault(p, False)
+    return exists
 
-def flatten_file_paths(yaml_dict):
-    paths = []
+def index_file_paths(yaml_dict, prefix=""):
+    """
+    {path: [every key path it occurs at]} of the file paths in yaml_dict,
+    in order of first occurrence, built in one pass. Key paths look like
+    tumor_sequence[0].sequence.fastq1, after prefix if given.
+    """
+    index = {}
 
-    def recurse(obj):
+    def recurse(obj, location):
         if isinstance(obj, dict):
-            for v in obj.values():
-                recurse(v)
+            for k, v in obj.items():
+                recurse(v, f"{location}.{k}" if location else str(k))
         elif isinstance(obj, list):
-            for item in obj:
-                recurse(item)
+            for i, item in enumerate(obj):
+                recurse(item, f"{location}[{i}]")
         elif isinstance(obj, str) and (obj.startswith("gs://") or obj.startswith("/")):
-            paths.append(obj)
+            index.setdefault(obj, []).append(location)
 
-    recurse(yaml_dict)
-    return paths
+    recurse(yaml_dict, prefix)
+    return index
 
 def extract_rg_field(readgroup_str, field):
     pattern = fr"{field}:([^\t\\]+)"
     match = re.search(pattern, readgroup_str)
     return match.group(1) if match else None
 
-def check_commenting_issues(yaml_text):
-    lines = yaml_text.splitlines()
-    for i, line in enumerate(lines):
-        if re.match(r"#\s*immuno\.problematic_amino_acids\s*:", line):
-            j = i + 1
-            while j < len(lines) and not re.match(r"^\s*immuno\.", lines[j]):
-                if re.match(r"^\s*-\s+\S", lines[j]):
-                    print(f"Improperly commented list item after commented key on line {i+1}: '{lines[j].strip()}'")
-                    break
-                j += 1
+ITEM = re.compile(r"^\s*-\s+\S")  # active list item
+WORD = re.compile(r"^\s*\w")
+IMMUNO_LINE = re.compile(r"^\s*immuno\.")
+COMMENTED_AMINO_ACIDS_KEY = re.compile(r"#\s*immuno\.problematic_amino_acids\s*:")
+ACTIVE_KEY_WITHOUT_VALUE = re.compile(r"^\s*immuno\.\w+:\s*$")  # active key, no value
 
-def check_empty_active_keys_with_commented_lists(yaml_text):
-    lines = yaml_text.splitlines()
-    for i, line in enumerate(lines):
-        if re.match(r"^\s*immuno\.\w+:\s*$", line):  # active key, no value
-            key_line = line.strip()
-            key_indent = len(line) - len(line.lstrip())
-            has_active_item = False
-            j = i + 1
-            while j < len(lines):
-                next_line = lines[j]
-                next_indent = len(next_line) - len(next_line.lstrip())
-                if next_indent <= key_indent and re.match(r"^\s*\w", next_line):
-                    break
-                if re.match(r"^\s*-\s+\S", next_line):  # active item
-                    has_active_item = True
-                    break
-                j += 1
-            if not has_active_item:
-                print(f"Key '{key_line}' appears active but has only commented-out list items (or none).")
+class Line:
+    """One line of YAML text, with what the lint rules ask of it worked out once."""
+    __slots__ = ("number", "text", "stripped", "indent", "is_item", "is_word", "is_immuno", "mentions_immuno")
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+        self.stripped = text.strip()
+        self.indent = len(text) - len(text.lstrip())
+        self.is_item = ITEM.match(text) is not None
+        self.is_word = WORD.match(text) is not None
+        self.mentions_immuno = "immuno." in text
+        self.is_immuno = self.mentions_immuno and IMMUNO_LINE.match(text) is not None
+
+class Linter:
+    """
+    Runs every registered rule over YAML text in one pass. A rule has
+    line(line), called with each Line in order, and finish(), called at
+    the end and returning what the rule found.
+    """
+    def __init__(self, rules=None):
+        self.rules = list(rules or [])
+
+    def register(self, rule):
+        self.rules.append(rule)
+        return rule
+
+    def run(self, yaml_text):
+        for number, text in enumerate(yaml_text.splitlines()):
+            line = Line(number, text)
+            for rule in self.rules:
+                rule.line(line)
+        return [rule.finish() for rule in self.rules]
+
+class CommentedListItemsRule:
+    """Active list items under a commented-out immuno.problematic_amino_acids key."""
+    def __init__(self):
+        self.pending = []  # commented keys not yet followed by an item or another immuno. key
+        self.issues = []
+
+    def line(self, line):
+        if line.is_immuno:
+            self.pending = []
+        elif line.is_item:
+            for key in self.pending:
+                self.issues.append(f"Improperly commented list item after commented key on line {key.number+1}: '{line.stripped}'")
+            self.pending = []
+        if line.mentions_immuno and COMMENTED_AMINO_ACIDS_KEY.match(line.text):
+            self.pending.append(line)
+
+    def finish(self):
+        return self.issues
+
+class EmptyActiveKeysRule:
+    """Active immuno. keys with no value and no active list items before the next key at their level."""
+    def __init__(self):
+        self.open = []  # keys still waiting for an item, indents increasing
+        self.empty = []
+
+    def line(self, line):
+        if line.is_word:
+            while self.open and self.open[-1].indent >= line.indent:
+                self.empty.append(self.open.pop())
+        elif line.is_item:
+            self.open = []
+        if line.mentions_immuno and ACTIVE_KEY_WITHOUT_VALUE.match(line.text):
+            self.open.append(line)
+
+    def finish(self):
+        self.empty += self.open
+        self.open = []
+        return [f"Key '{key.stripped}' appears active but has only commented-out list items (or none)."
+                for key in sorted(self.empty, key=lambda key: key.number)]
 
 def is_proper_fastq_pair(fq1, fq2):
     fq1_base = os.path.basename(fq1)
@@ -95,107 +194,167 @@ def is_proper_fastq_pair(fq1, fq2):
         return True
     return False
 
-def check_commented_blocks(yaml_text):
-    results = []
-    checks = {
-        'problematic_amino_acids': {
-            'keyword': 'immuno.problematic_amino_acids:',
-            'no_text_message': "No problematic amino acids in this run",
-            'has_text_message': "Problematic amino acids selected:"
-        },
-        'clinical_mhc_classI_alleles': {
-            'keyword': 'immuno.clinical_mhc_classI_alleles:',
-            'no_text_message': "Class I HLA alleles commented out",
-            'has_text_message': "Class I HLA alleles selected:"
-        },
-        'clinical_mhc_classII_alleles': {
-            'keyword': 'immuno.clinical_mhc_classII_alleles:',
-            'no_text_message': "Class II HLA alleles commented out",
-            'has_text_message': "Class II HLA alleles selected:"
-        }
+COMMENTED_BLOCKS = {
+    'problematic_amino_acids': {
+        'keyword': 'immuno.problematic_amino_acids:',
+        'no_text_message': "No problematic amino acids in this run",
+        'has_text_message': "Problematic amino acids selected:"
+    },
+    'clinical_mhc_classI_alleles': {
+        'keyword': 'immuno.clinical_mhc_classI_alleles:',
+        'no_text_message': "Class I HLA alleles commented out",
+        'has_text_message': "Class I HLA alleles selected:"
+    },
+    'clinical_mhc_classII_alleles': {
+        'keyword': 'immuno.clinical_mhc_classII_alleles:',
+        'no_text_message': "Class II HLA alleles commented out",
+        'has_text_message': "Class II HLA alleles selected:"
     }
-    lines = yaml_text.splitlines()
-    for check_name, check_info in checks.items():
-        found = False
-        for idx, line in enumerate(lines):
-            if check_info['keyword'] in line:
-                found = True
-                if line.strip().startswith('#'):
-                    results.append(check_info['no_text_message'])
+}
+
+class CommentedBlocksRule:
+    """Whether each of COMMENTED_BLOCKS is commented out, and if not the lines under its first mention."""
+    def __init__(self):
+        self.results = {}  # check name -> lines to report, for checks found so far
+        self.collecting = []  # checks whose block is still being read
+
+    def line(self, line):
+        for check_name in list(self.collecting):
+            if line.stripped.startswith('#') or line.stripped.startswith('immuno.'):
+                self.collecting.remove(check_name)
+            elif line.stripped:
+                self.results[check_name].append(f"  {line.stripped}")
+        if not line.mentions_immuno or len(self.results) == len(COMMENTED_BLOCKS):
+            return
+        for check_name, check_info in COMMENTED_BLOCKS.items():
+            if check_name not in self.results and check_info['keyword'] in line.text:
+                if line.stripped.startswith('#'):
+                    self.results[check_name] = [check_info['no_text_message']]
                 else:
-                    results.append(check_info['has_text_message'])
-                    j = idx + 1
-                    while j < len(lines):
-                        next_line = lines[j].strip()
-                        if next_line.startswith('#') or next_line.startswith('immuno.'):
-                            break
-                        if next_line:
-                            results.append(f"  {next_line}")
-                        j += 1
-                break
-        if not found:
-            results.append(f"{check_name} not found in YAML")
-    return results
-
-def validate_yaml(yaml_file):
+                    self.results[check_name] = [check_info['has_text_message']]
+                    self.collecting.append(check_name)
+
+    def finish(self):
+        return [result for check_name in COMMENTED_BLOCKS
+                for result in self.results.get(check_name, [f"{check_name} not found in YAML"])]
+
+def check_commenting_issues(yaml_text):
+    return Linter([CommentedListItemsRule()]).run(yaml_text)[0]
+
+def check_empty_active_keys_with_commented_lists(yaml_text):
+    return Linter([EmptyActiveKeysRule()]).run(yaml_text)[0]
+
+def check_commented_blocks(yaml_text):
+    return Linter([CommentedBlocksRule()]).run(yaml_text)[0]
+
+def lint(yaml_text):
+    """(commented list items, empty active keys, commented blocks) of yaml_text, in one pass over it."""
+    return Linter([CommentedListItemsRule(), EmptyActiveKeysRule(), CommentedBlocksRule()]).run(yaml_text)
+
+def duplicate_paths(path_index):
+    """{path: locations} of the paths of an index_file_paths index that occur more than once."""
+    return {p: locations for p, locations in path_index.items() if len(locations) > 1}
+
+def fastq_pair_mismatches(immuno):
+    mismatches = []
+    for group in ['tumor_sequence', 'normal_sequence', 'rna_sequence']:
+        sequences = immuno.get(group, [])
+        for i, seq in enumerate(sequences):
+            s = seq["sequence"]
+            fq1, fq2 = s["fastq1"], s["fastq2"]
+            if not is_proper_fastq_pair(fq1, fq2):
+                mismatches.append((group, i + 1, fq1, fq2))
+    return mismatches
+
+def sm_mismatches(immuno):
+    mismatches = []
+    expected_sms = {
+        "tumor_sequence": immuno.get("tumor_sample_name"),
+        "normal_sequence": immuno.get("normal_sample_name"),
+        "rna_sequence": immuno.get("sample_name"),
+    }
+    for group, expected_sm in expected_sms.items():
+        sequences = immuno.get(group, [])
+        for i, seq in enumerate(sequences):
+            rg = seq["readgroup"]
+            actual_sm = extract_rg_field(rg, "SM")
+            if actual_sm != expected_sm:
+                mismatches.append((group, i + 1, expected_sm, actual_sm))
+    return mismatches
+
+def read_immuno_yaml(yaml_file):
+    """(yaml_text, immuno inputs without their "immuno." prefix). Raises on unreadable or unparseable files."""
+    with open(yaml_file) as f:
+        yaml_text = f.read()
+    data = yaml.safe_load(yaml_text)
+    immuno = {k[len("immuno.") :]: v for k, v in data.items() if k.startswith("immuno.")}
+    return yaml_text, immuno
+
+class ExistenceCache:
+    """Whether paths exist, remembered so a path shared by many YAMLs is only checked once."""
+    def __init__(self, store=None, workers=DEFAULT_WORKERS):
+        self.store = store or GsutilStore()
+        self.workers = workers
+        self.known = {}
+
+    def check(self, paths):
+        unknown = [p for p in paths if p not in self.known]
+        if unknown:
+            self.known.update(files_exist(unknown, store=self.store, workers=self.workers))
+        return {p: self.known[p] for p in paths}
+
+def validate_yaml(yaml_file, store=None, workers=DEFAULT_WORKERS, cache=None):
     print(f"Validating: {yaml_file}\n")
 
     try:
-        with open(yaml_file) as f:
-            yaml_text = f.read()
-            data = yaml.safe_load(yaml_text)
+        yaml_text, immuno = read_immuno_yaml(yaml_file)
     except Exception as e:
         print(f"Failed to read or parse YAML: {e}")
         return
 
-    immuno = {k[len("immuno.") :]: v for k, v in data.items() if k.startswith("immuno.")} 
     if not immuno:
         print("Error: No keys starting with 'immuno.' were found.") 
         return
 
+    try:
+        print_checks(yaml_text, immuno, cache or ExistenceCache(store, workers))
+    except Exception as e:
+        print(f"\nError: inputs aren't structured as expected, skipping the remaining checks: {e!r}")
+        return
+
+    print("\nValidation complete.") 
+
+def print_checks(yaml_text, immuno, cache):
+    """Print what each check of validate_yaml finds in a parsed file."""
     print("Checking file paths...")
-    paths = flatten_file_paths(immuno) 
-    missing = [p for p in paths if not file_exists(p)] 
+    path_index = index_file_paths(immuno, "immuno")
+    exists = cache.check(path_index)
+    missing = [p for p in exists if not exists[p]]
     if missing:
         print("Missing file paths:") 
         for p in missing:
-            print(f" - {p}") 
+            print(f" - {p} (at {', '.join(path_index[p])})") 
     else:
         print("All file paths exist.") 
 
     print("\nChecking for duplicate file paths...")
-    duplicates = set([p for p in paths if paths.count(p) > 1]) 
+    duplicates = duplicate_paths(path_index)
     if duplicates:
         print("Duplicate file paths:") 
-        for p in duplicates:
-            print(f" - {p}") 
+        for p, locations in duplicates.items():
+            print(f" - {p} (at {', '.join(locations)})") 
     else:
         print("No duplicate file paths found.") 
 
     print("\nChecking FASTQ pairings...")
-    for group in ['tumor_sequence', 'normal_sequence', 'rna_sequence']: 
-        sequences = immuno.get(group, []) 
-        for i, seq in enumerate(sequences):
-            s = seq["sequence"] 
-            fq1, fq2 = s["fastq1"], s["fastq2"] 
-            if not is_proper_fastq_pair(fq1, fq2): 
-                print(f"Pairing mismatch in {group} entry {i+1}:") 
-                print(f"   fastq1: {fq1}") 
-                print(f"   fastq2: {fq2}") 
+    for group, entry, fq1, fq2 in fastq_pair_mismatches(immuno):
+        print(f"Pairing mismatch in {group} entry {entry}:") 
+        print(f"   fastq1: {fq1}") 
+        print(f"   fastq2: {fq2}") 
 
     print("\n Checking readgroup SM fields...")
-    expected_sms = { #
-        "tumor_sequence": immuno.get("tumor_sample_name"), 
-        "normal_sequence": immuno.get("normal_sample_name"), 
-        "rna_sequence": immuno.get("sample_name"), 
-    }
-    for group, expected_sm in expected_sms.items(): 
-        sequences = immuno.get(group, []) 
-        for i, seq in enumerate(sequences): 
-            rg = seq["readgroup"] 
-            actual_sm = extract_rg_field(rg, "SM") 
-            if actual_sm != expected_sm: 
-                print(f"SM mismatch in {group} entry {i+1}: expected '{expected_sm}', found '{actual_sm}'") 
+    for group, entry, expected_sm, actual_sm in sm_mismatches(immuno):
+        print(f"SM mismatch in {group} entry {entry}: expected '{expected_sm}', found '{actual_sm}'") 
 
     print("\nRNA CN fields:") 
     for seq in immuno.get("rna_sequence", []): 
@@ -204,21 +363,134 @@ def validate_yaml(yaml_file):
         print(f" - CN: {cn}") 
     print(f"Strand: {immuno.get('strand')}") 
 
+    commented_items, empty_keys, comment_block_results = lint(yaml_text)
     print("\nChecking for improperly commented list items...") 
-    check_commenting_issues(yaml_text) 
-    check_empty_active_keys_with_commented_lists(yaml_text) 
+    for issue in commented_items + empty_keys:
+        print(issue)
 
-    # Call the new function and print its results
     print("\nChecking commented blocks status:")
-    comment_block_results = check_commented_blocks(yaml_text)
     for result in comment_block_results:
         print(result)
 
-    print("\nValidation complete.") 
+# Error codes of the problems check_yaml reports
+PARSE_ERROR = "parse-error"
+NO_IMMUNO_KEYS = "no-immuno-keys"
+MISSING_PATH = "missing-path"
+DUPLICATE_PATH = "duplicate-path"
+FASTQ_PAIR_MISMATCH = "fastq-pair-mismatch"
+SM_MISMATCH = "sm-mismatch"
+COMMENTED_LIST_ITEM = "commented-list-item"
+EMPTY_ACTIVE_KEY = "empty-active-key"
+SCHEMA_ERROR = "schema-error"
+
+def problem(check, code, message, **details):
+    return {"check": check, "code": code, "message": message, **details}
+
+def check_yaml(yaml_file, cache, parsed=None, path_index=None):
+    """
+    The checks of validate_yaml as one structured result,
+    {"file", "valid", "problems": [{"check", "code", "message", ...}], "info"}.
+    parsed is the file's read_immuno_yaml result, or the exception reading it raised, if already read,
+    and path_index its index_file_paths index, if already built.
+    Inputs not shaped as the checks expect, e.g. a sequence without a
+    fastq2, are reported as a schema error rather than raised.
+    """
+    result = {"file": str(yaml_file), "valid": False, "problems": [], "info": {}}
+    problems = result["problems"]
+    try:
+        if isinstance(parsed, Exception):
+            raise parsed
+        yaml_text, immuno = parsed or read_immuno_yaml(yaml_file)
+    except Exception as e:
+        problems.append(problem("parse", PARSE_ERROR, f"Failed to read or parse YAML: {e}"))
+        return result
+    if not immuno:
+        problems.append(problem("parse", NO_IMMUNO_KEYS, "No keys starting with 'immuno.' were found."))
+        return result
+
+    try:
+        check_inputs(result, yaml_text, immuno, cache, path_index)
+    except Exception as e:
+        problems.append(problem("schema", SCHEMA_ERROR, f"Inputs aren't structured as expected: {e!r}"))
+    result["valid"] = not problems
+    return result
+
+def check_inputs(result, yaml_text, immuno, cache, path_index=None):
+    """Add the problems and info check_yaml finds in a parsed file to result."""
+    problems = result["problems"]
+    path_index = path_index if path_index is not None else index_file_paths(immuno, "immuno")
+    exists = cache.check(path_index)
+    problems += [problem("file_paths", MISSING_PATH, f"Missing file path {p}", path=p, locations=path_index[p])
+                 for p in exists if not exists[p]]
+    problems += [problem("duplicate_paths", DUPLICATE_PATH, f"Duplicate file path {p}", path=p, locations=locations)
+                 for p, locations in duplicate_paths(path_index).items()]
+    problems += [problem("fastq_pairs", FASTQ_PAIR_MISMATCH, f"Pairing mismatch in {group} entry {entry}",
+                         group=group, entry=entry, fastq1=fq1, fastq2=fq2)
+                 for group, entry, fq1, fq2 in fastq_pair_mismatches(immuno)]
+    problems += [problem("readgroup_sm", SM_MISMATCH,
+                         f"SM mismatch in {group} entry {entry}: expected '{expected}', found '{actual}'",
+                         group=group, entry=entry, expected=expected, found=actual)
+                 for group, entry, expected, actual in sm_mismatches(immuno)]
+    commented_items, empty_keys, commented_blocks = lint(yaml_text)
+    problems += [problem("commenting", COMMENTED_LIST_ITEM, issue) for issue in commented_items]
+    problems += [problem("commenting", EMPTY_ACTIVE_KEY, issue) for issue in empty_keys]
+    result["info"] = {
+        "rnaCn": [extract_rg_field(seq["readgroup"], "CN") for seq in immuno.get("rna_sequence", [])],
+        "strand": immuno.get("strand"),
+        "commentedBlocks": commented_blocks,
+    }
+
+def yaml_files_in(paths):
+    """The given YAML files, and every .yaml or .yml file directly in the given directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith((".yaml", ".yml")))
+        else:
+            files.append(path)
+    return files
+
+def check_yamls(yaml_files, store=None, workers=DEFAULT_WORKERS):
+    """
+    check_yaml of many files, yielded in order. Files are read and their
+    paths indexed concurrently, then every path they name is checked at
+    once through one shared ExistenceCache.
+    """
+    def read(yaml_file):
+        try:
+            contents = read_immuno_yaml(yaml_file)
+        except Exception as e:
+            return e, None
+        return contents, index_file_paths(contents[1], "immuno")
+
+    cache = ExistenceCache(store, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parsed = list(pool.map(read, yaml_files))
+    cache.check([p for _, path_index in parsed if path_index for p in path_index])
+    for yaml_file, (contents, path_index) in zip(yaml_files, parsed):
+        yield check_yaml(yaml_file, cache, contents, path_index)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Validate an immuno YAML file for common formatting and logic errors.") 
-    parser.add_argument("yaml_file", help="Path to the YAML file to validate.") 
+    parser = argparse.ArgumentParser(description="Validate immuno YAML files for common formatting and logic errors.") 
+    parser.add_argument("yaml_files", nargs="+", help="YAML files to validate, or directories of them.") 
+    parser.add_argument("--jsonl", action="store_true",
+                        help="write one JSON result per file, with an error code for each problem, "
+                        "and exit nonzero if any file has problems")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"files, GCS prefixes, or local paths to check at once. Default {DEFAULT_WORKERS}")
+    parser.add_argument("--gcs-root",
+                        help="check gs:// paths against this local directory instead of GCS, gs://bucket/key being <dir>/bucket/key")
     args = parser.parse_args() 
 
-    validate_yaml(args.yaml_file) 
+    store = LocalDirStore(args.gcs_root) if args.gcs_root else GsutilStore()
+    yaml_files = yaml_files_in(args.yaml_files)
+    if args.jsonl:
+        valid = True
+        for result in check_yamls(yaml_files, store=store, workers=args.workers):
+            print(json.dumps(result), flush=True)
+            valid = valid and result["valid"]
+        sys.exit(0 if valid else 1)
+    cache = ExistenceCache(store, args.workers)
+    for yaml_file in yaml_files:
+        validate_yaml(yaml_file, cache=cache) 